@@ -1,12 +1,20 @@
+import asyncio
 import logging
+import os
 import random
+import signal
+import sys
+import time
 from pathlib import Path
 
 import discord.errors
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot, Bot
 
 from utils import reporter
 from utils.cfg import cfg
+from utils.commands import sync_commands
+from utils.db import create_client
+from utils.startup import startup
 
 logging.basicConfig(format="%(levelname)5s %(asctime)s [%(name)s] %(filename)s:%(lineno)d|%(funcName)s(): %(message)s")
 log = logging.getLogger("discord_bot")
@@ -18,25 +26,91 @@ intents.messages = True
 intents.message_content = True
 intents.guild_messages = True
 
-log.info('Loading Plugins')
-class BridgeBot(Bot):
+# shards this process connects, e.g. BRIDGE_SHARD_IDS=0,1 with several processes on one shard_count
+shard_count = cfg.get("discord.shard_count", 0) or None
+shard_ids = os.environ.get("BRIDGE_SHARD_IDS")
+try:
+    shard_ids = [int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else cfg.get("discord.shard_ids", None)
+except ValueError:
+    log.error(f"Invalid BRIDGE_SHARD_IDS \"{shard_ids}\", expected comma separated shard ids like 0,1")
+    sys.exit(1)
+# discord.py only accepts shard ids together with the total, check here to fail with a readable message
+if shard_ids and not shard_count:
+    log.error("Shard ids are set (BRIDGE_SHARD_IDS or discord.shard_ids) but discord.shard_count isn't, set it to the total number of shards")
+    sys.exit(1)
+if shard_ids and any(not 0 <= shard_id < shard_count for shard_id in shard_ids):
+    log.error(f"Shard ids {list(shard_ids)} must be between 0 and discord.shard_count - 1 ({shard_count - 1})")
+    sys.exit(1)
+sharded = bool(shard_count or shard_ids)
+
+
+class BridgeBot(AutoShardedBot if sharded else Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # shared by every plugin, nothing connects until the first query
+        self.mongo = create_client()
+        self.ready_once = False
+
+    async def load_plugin(self, extension_name):
+        started = time.perf_counter()
+        try:
+            await self.load_extension(extension_name)
+        except Exception as err:
+            log.error(f"Failed to load plugin \"{extension_name}\"")
+            log.exception(err)
+            return
+        log.debug(f"Loaded plugin \"{extension_name}\" in {time.perf_counter() - started:.2f}s")
+
     async def setup_hook(self):
-        for path in Path("plugins").glob('**/*.py'):
-            plugin_name = path.parts[1]
-            if path.stem != plugin_name:
-                log.warning(f"Skipping plugin {plugin_name}")
+        # docker stops the container with SIGTERM, which python as PID 1 ignores, close cleanly
+        # instead so the plugins flush their buffered mappings before the SIGKILL
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: self.loop.create_task(self.close()))
+        except NotImplementedError:
+            # no signal handlers in the windows event loop
+            pass
+        # only plugins/<name>/<name>.py are entry points, other modules are loaded by the plugins themselves
+        extension_names = []
+        for path in sorted(Path("plugins").iterdir()):
+            if not path.is_dir() or path.name.startswith("__"):
                 continue
-            extension_name = f"plugins.{plugin_name}.{plugin_name}"
-            log.debug(f"Loading Plugin \"{extension_name}\"")
+            if not (path / f"{path.name}.py").is_file():
+                log.warning(f"Skipping plugin {path.name}")
+                continue
+            extension_names.append(f"plugins.{path.name}.{path.name}")
+        with startup.phase("plugins"):
+            await asyncio.gather(*(self.load_plugin(extension_name) for extension_name in extension_names))
+        # needs every plugin's commands but not the gateway, so it runs while connecting
+        self.loop.create_task(self.sync_commands())
+        startup.begin("gateway")
+
+    async def sync_commands(self):
+        with startup.phase("command sync"):
             try:
-                await bot.load_extension(extension_name)
+                await sync_commands(self.tree, self.mongo.bridge.state, cfg.get("discord.sync_guilds", []))
             except Exception as err:
-                log.error(f"Failed to load plugin \"{extension_name}\"")
-                log.exception(err)
+                # bridging doesn't depend on the commands
+                log.error(f"Failed to sync commands: {err}")
+
+    async def on_ready(self):
+        if self.ready_once:
+            return
+        self.ready_once = True
+        startup.end("gateway")
+        log.info(f"Ready, startup phases: {startup.summary()}")
+
+    async def close(self):
+        # plugins flush their buffered writes while being unloaded, so the client goes last
+        await super().close()
+        self.mongo.close()
 
-log.info('Finished loading Plugins')
 
 log.info('Starting bot')
-bot = BridgeBot(command_prefix=str(random.random()), intents=intents)
+# edits and deletes are bridged from raw events, so the message cache only saves the odd lookup
+options = {}
+if sharded:
+    options.update(shard_count=shard_count, shard_ids=shard_ids and list(shard_ids))
+bot = BridgeBot(command_prefix=str(random.random()), intents=intents,
+                max_messages=cfg.get("discord.max_messages", 1000) or None, **options)
 reporter.bot = bot
 bot.run(cfg["discord.secret"])
@@ -0,0 +1,181 @@
+"""
+Checks the attachment re-upload pipeline end to end against a local HTTP server standing in
+for Discord's CDN: every attachment is downloaded once no matter how many targets it goes
+to, identical files are stored once, guild upload limits are respected and files already on
+disk aren't downloaded again.
+
+Run from the bridge-bot folder, after installing harness/requirements.txt:
+
+    python -m harness.attachments --channels 6 --messages 50
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import os
+import random
+import sys
+import tempfile
+from types import SimpleNamespace
+
+from aiohttp import web
+
+
+class FakeCDN:
+    """Serves deterministic random bytes for attachment URLs in chunks, counting every download."""
+
+    def __init__(self):
+        # path -> (size, content seed)
+        self.files = {}
+        self.downloads = collections.Counter()
+        self.runner = None
+        self.base_url = None
+
+    def content(self, path):
+        size, content_seed = self.files[path]
+        return random.Random(content_seed).randbytes(size)
+
+    async def serve(self, request):
+        path = request.path
+        if path not in self.files:
+            raise web.HTTPNotFound()
+        self.downloads[path] += 1
+        data = self.content(path)
+        response = web.StreamResponse(headers={"Content-Length": str(len(data))})
+        await response.prepare(request)
+        for i in range(0, len(data), 256 * 1024):
+            await response.write(data[i:i + 256 * 1024])
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", self.serve)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def attachment(self, id, filename, size, content_seed):
+        path = f"/attachments/{id}/{filename}"
+        self.files[path] = (size, content_seed)
+        return SimpleNamespace(id=id, url=self.base_url + path, filename=filename, size=size,
+                               description=None, content_type="application/octet-stream")
+
+
+async def run(args):
+    from harness.bench import connect
+    from harness.fake import FakeBot, FakeGateway, FakeHTTP, FakeMessage, wait_idle
+    from plugins.bridge.bridge import Bridge
+    from utils.attachments import AttachmentStore
+    from utils.render import RenderCache
+
+    cdn = FakeCDN()
+    await cdn.start()
+    rng = random.Random(args.seed)
+
+    gateway = FakeGateway(bridges=1, channels_per_bridge=args.channels, seed=args.seed)
+    mongo = connect(args.mongodb)
+    await mongo.drop_database("bridge_attachments")
+    db = mongo.bridge_attachments
+    await db.bridges.insert_many([dict(bridge) for bridge in gateway.topology["bridges"]])
+    http = FakeHTTP(id_base=2 * 10 ** 17)
+    bot = FakeBot(http, gateway.topology)
+    channels = list(bot.channels.values())
+    # one target guild without boosts and a tiny upload limit
+    small = channels[-1]
+    small.guild.filesize_limit = args.small_limit
+
+    cache_dir = tempfile.mkdtemp(prefix="bridge-attachments-")
+    cog = Bridge(bot, db=db)
+    cog.attachments = AttachmentStore(cache_dir, concurrency=args.concurrency)
+    cog.renders = RenderCache(link_attachments=False)
+    await cog.cog_load()
+    await cog.warm_task
+
+    messages = []
+    attachment_ids = iter(range(10 ** 16, 10 ** 17))
+    for i in range(args.messages):
+        source = rng.choice(channels[:-1])
+        attachments = [
+            cdn.attachment(
+                next(attachment_ids), f"file{i}-{n}.bin",
+                rng.choice((16 * 1024, 512 * 1024, 3 * 1024 * 1024)),
+                # a few files are posted more than once under different attachment ids
+                rng.randrange(args.messages // 2)
+            )
+            for n in range(rng.randint(1, 3))
+        ]
+        message = FakeMessage(next(gateway.message_ids), source, rng.choice(gateway.users), f"msg {i}",
+                              attachments=attachments)
+        source.messages[message.id] = message
+        messages.append(message)
+        await cog.on_message(message)
+    await wait_idle(cog)
+
+    failures = []
+    repeated = [path for path, count in cdn.downloads.items() if count > 1]
+    if repeated:
+        failures.append(f"{len(repeated)} attachments downloaded more than once")
+    unique = {cdn.files[path] for path in cdn.downloads}
+    stored = [name for name in os.listdir(cache_dir) if not name.endswith(".part")]
+    if len(stored) != len(unique):
+        failures.append(f"{len(stored)} files stored for {len(unique)} distinct contents")
+    for name in stored:
+        with open(os.path.join(cache_dir, name), "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != name:
+                failures.append(f"{name} doesn't match its content hash")
+
+    sends = [call for call in http.calls if call[0] == "POST" and call[1] == "/channels/{id}/messages"]
+    for method, route, channel_id, payload, at in sends:
+        guild = bot.channels[channel_id].guild
+        uploaded = [
+            attachment for message in messages for attachment in message.attachments
+            if attachment.filename in payload["files"]
+        ]
+        if sum(attachment.size for attachment in uploaded) > guild.filesize_limit:
+            failures.append(f"upload to {channel_id} exceeds its guild's limit")
+    expected_sends = args.messages * (args.channels - 1)
+    if len(sends) != expected_sends:
+        failures.append(f"{len(sends)} sends instead of {expected_sends}")
+    linked = sum(payload["content"].count(cdn.base_url) for _, _, channel_id, payload, _ in sends if channel_id == small.id)
+    if not linked:
+        failures.append("nothing was linked in the guild with the small upload limit")
+
+    # the same attachments again, e.g. replayed after a restart, come from disk
+    downloads = sum(cdn.downloads.values())
+    for message in messages:
+        await cog.attachments.prepare(message, channels[0])
+    if sum(cdn.downloads.values()) != downloads:
+        failures.append("cached attachments were downloaded again")
+
+    print(f"{args.messages} messages to {args.channels - 1} targets each: {len(sends)} sends, "
+          f"{sum(cdn.downloads.values())} downloads of {len(cdn.files)} attachments, "
+          f"{len(stored)} files on disk, {linked} links for the small guild, store {cog.attachments.stats()}")
+    await cog.cog_unload()
+    await cdn.stop()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=5, help="channels in the bridge")
+    parser.add_argument("--messages", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--small-limit", type=int, default=1024 * 1024, help="upload limit of one target guild")
+    parser.add_argument("--mongodb", help="MongoDB uri to use instead of mongomock-motor")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Drives the Bridge cog with synthetic gateway traffic against the fake REST layer and an
+in-process MongoDB stand-in, and reports throughput, end-to-end latency, REST calls and
+db operations per message. Run it before and after a change to catch regressions.
+
+Run from the bridge-bot folder (it reads main.cfg like the bot does), after installing
+harness/requirements.txt:
+
+    python -m harness.bench --bridges 10 --channels 4 --events 5000 --rate 500
+    python -m harness.bench --mongodb mongodb://localhost:27017   # real MongoDB instead
+    python -m harness.bench --render-only                          # just the renderer
+
+Latency is measured from handing an event to the listener until the fake REST call that
+delivers it to a target, for new messages and edits. Edits are held back for
+bridge.edit_window on purpose, so their latency includes it.
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import logging
+import re
+import time
+
+DB_NAME = "bridge_bench"
+
+
+class CountingCollection:
+    """Passes everything through to a motor collection, counting each operation."""
+
+    def __init__(self, collection, counter):
+        self.collection = collection
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            self.counter[f"{self.collection.name}.{name}"] += 1
+            return attr(*args, **kwargs)
+        return call
+
+    def __getitem__(self, name):
+        return CountingCollection(self.collection[name], self.counter)
+
+
+class CountingDatabase:
+    def __init__(self, db):
+        self.db = db
+        self.counter = collections.Counter()
+
+    def __getattr__(self, name):
+        return CountingCollection(getattr(self.db, name), self.counter)
+
+    def __getitem__(self, name):
+        return CountingCollection(self.db[name], self.counter)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q / 100 * (len(values) - 1)))]
+
+
+def connect(uri):
+    if uri:
+        import motor.motor_asyncio
+        return motor.motor_asyncio.AsyncIOMotorClient(uri)
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("mongomock-motor is missing, install harness/requirements.txt or pass --mongodb")
+    return AsyncMongoMockClient()
+
+
+async def bench(args):
+    from harness.fake import FakeBot, FakeGateway, FakeHTTP, dispatch, wait_idle
+    from plugins.bridge.bridge import Bridge
+
+    gateway = FakeGateway(
+        bridges=args.bridges,
+        channels_per_bridge=args.channels,
+        unbridged_channels=args.unbridged,
+        seed=args.seed
+    )
+    mongo = connect(args.mongodb)
+    await mongo.drop_database(DB_NAME)
+    await mongo[DB_NAME].bridges.insert_many([dict(bridge) for bridge in gateway.topology["bridges"]])
+
+    http = FakeHTTP(id_base=2 * 10 ** 17, latency=args.latency, rate=args.api_rate, burst=args.api_burst)
+    bot = FakeBot(http, gateway.topology)
+    db = CountingDatabase(mongo[DB_NAME])
+    cog = Bridge(bot, db=db)
+    if args.bot_rate:
+        cog.scheduler.rate = args.bot_rate
+    if args.bot_burst:
+        cog.scheduler.burst = args.bot_burst
+    await cog.cog_load()
+    # no change stream or backfill, the routing index is loaded once
+    await cog.warm_task
+    db.counter.clear()
+
+    events = list(gateway.events(
+        args.events,
+        edit_ratio=args.edit_ratio,
+        delete_ratio=args.delete_ratio,
+        reply_ratio=args.reply_ratio
+    ))
+    # content -> monotonic time the event reached the listener
+    dispatched = {}
+    started = time.monotonic()
+    for i, event in enumerate(events):
+        if args.rate:
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if "content" in event:
+            dispatched[event["content"]] = time.monotonic()
+        await dispatch(cog, bot, event)
+    ingested = time.monotonic() - started
+    await wait_idle(cog, settle=args.settle)
+    elapsed = time.monotonic() - started - args.settle
+    await cog.cog_unload()
+
+    latencies = {"new": [], "edit": []}
+    for method, route, channel_id, payload, at in http.calls:
+        if method not in ("POST", "PATCH") or not payload.get("content"):
+            continue
+        match = re.search(r"msg \d+( edited [\d.]+)?", payload["content"])
+        if match and match.group(0) in dispatched:
+            latencies["edit" if match.group(1) else "new"].append((at - dispatched[match.group(0)]) * 1000)
+
+    kinds = collections.Counter(event["type"] for event in events)
+    bridged = kinds["new"] or 1
+    calls = collections.Counter(f"{call[0]} {call[1]}" for call in http.calls)
+    return {
+        "events"                : len(events),
+        "kinds"                 : dict(kinds),
+        "ingest_events_per_sec" : len(events) / ingested if ingested else 0.0,
+        "events_per_sec"        : len(events) / elapsed if elapsed > 0 else 0.0,
+        "elapsed_sec"           : elapsed,
+        "latency_ms"            : {
+            kind: {
+                "count": len(values),
+                "p50"  : percentile(values, 50),
+                "p99"  : percentile(values, 99)
+            }
+            for kind, values in latencies.items()
+        },
+        "rest_calls"            : sum(calls.values()),
+        "rest_calls_per_message": sum(calls.values()) / bridged,
+        "rest_routes"           : dict(calls),
+        "rate_limited"          : http.rate_limited,
+        "db_ops"                : sum(db.counter.values()),
+        "db_ops_per_message"    : sum(db.counter.values()) / bridged,
+        "db_routes"             : dict(db.counter),
+        "coalesced"             : cog.coalescer.coalesced,
+        "mapping_cache"         : cog.mappings.cache.stats(),
+        "render_cache"          : cog.renders.stats()
+    }
+
+
+def bench_render(args):
+    from harness.fake import FakeBot, FakeGateway, FakeHTTP, FakeMessage
+    from utils.render import render_message
+
+    gateway = FakeGateway(bridges=1, channels_per_bridge=1, seed=args.seed)
+    bot = FakeBot(FakeHTTP(id_base=2 * 10 ** 17), gateway.topology)
+    channel = next(iter(bot.channels.values()))
+    messages = [
+        FakeMessage(i, channel, gateway.users[i % len(gateway.users)], f"msg {i}" + "\nline" * (i % 3))
+        for i in range(1000)
+    ]
+    rounds = max(1, args.events // len(messages))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            render_message(message)
+    elapsed = time.perf_counter() - started
+    count = rounds * len(messages)
+    return {"renders": count, "renders_per_sec": count / elapsed, "usec_per_render": elapsed / count * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bridges", type=int, default=5)
+    parser.add_argument("--channels", type=int, default=3, help="channels per bridge")
+    parser.add_argument("--unbridged", type=int, default=5, help="channels with traffic that isn't bridged")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="gateway events per second, 0 for as fast as possible")
+    parser.add_argument("--edit-ratio", type=float, default=0.1)
+    parser.add_argument("--delete-ratio", type=float, default=0.05)
+    parser.add_argument("--reply-ratio", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake REST latency in seconds")
+    parser.add_argument("--api-rate", type=float, default=5, help="requests per second discord allows per channel")
+    parser.add_argument("--api-burst", type=int, default=5)
+    parser.add_argument("--bot-rate", type=float, help="override bridge.scheduler.rate")
+    parser.add_argument("--bot-burst", type=int, help="override bridge.scheduler.burst")
+    parser.add_argument("--mongodb", help="MongoDB uri to use instead of mongomock-motor")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds without work before the run counts as done")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--render-only", action="store_true", help="only benchmark the message renderer")
+    parser.add_argument("--json", action="store_true", help="print the raw report as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = bench_render(args) if args.render_only else asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Stand-ins for the parts of discord.py the bridge touches, plus a fake gateway producing
+synthetic traffic. Nothing here talks to Discord, every REST call lands in FakeHTTP.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import re
+import time
+from types import SimpleNamespace
+
+from discord import Colour
+
+http_log = logging.getLogger("discord.http")
+
+
+def shard_of(guild_id, shard_count):
+    # same formula discord uses to place guilds on shards
+    return (guild_id >> 22) % shard_count
+
+
+class FakeHTTP:
+    """
+    Records every REST call the bridge makes. Optionally adds latency and enforces a
+    per-channel rate limit, reporting 429s through discord.py's logger like the real client.
+    """
+
+    def __init__(self, id_base, latency=0.0, rate=None, burst=5):
+        self.ids = itertools.count(id_base)
+        self.latency = latency
+        self.rate = rate
+        self.burst = burst
+        # channel_id -> [tokens, last refill]
+        self.buckets = {}
+        # (method, route, channel_id, payload, monotonic time) per call
+        self.calls = []
+        self.rate_limited = 0
+
+    def next_id(self):
+        return next(self.ids)
+
+    def _take(self, channel_id):
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(channel_id, [self.burst, now])
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    async def request(self, method, route, channel_id, **payload):
+        if self.rate:
+            while (retry_after := self._take(channel_id)) > 0:
+                self.rate_limited += 1
+                http_log.warning("We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.",
+                                 method, f"https://discord.com/api/v10{route}", retry_after)
+                await asyncio.sleep(retry_after)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((method, re.sub(r"\d+", "{id}", route), channel_id, payload, time.monotonic()))
+        return payload
+
+
+class FakeUser:
+    def __init__(self, id, name, bot=False):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.color = self.colour = Colour(0)
+        self.avatar = None
+        self.default_avatar = self.display_avatar = SimpleNamespace(url=f"https://cdn.example/avatars/{id}.png")
+        self.mention = f"<@{id}>"
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, id, name, filesize_limit=25 * 1024 * 1024):
+        self.id = id
+        self.name = name
+        self.filesize_limit = filesize_limit
+
+
+class FakeMessage:
+    def __init__(self, id, channel, author, content, reference=None, attachments=()):
+        self.id = id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embeds = []
+        self.attachments = list(attachments)
+        self.reference = SimpleNamespace(message_id=reference) if reference else None
+        self.mentions = []
+        self.webhook_id = None
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+
+class FakePartialMessage:
+    def __init__(self, channel, id):
+        self.channel = channel
+        self.id = id
+        self.guild = channel.guild
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+    def to_reference(self, fail_if_not_exists=True):
+        return SimpleNamespace(message_id=self.id, channel_id=self.channel.id, jump_url=self.jump_url,
+                               fail_if_not_exists=fail_if_not_exists)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.channel.http.request("PATCH", f"/channels/{self.channel.id}/messages/{self.id}", self.channel.id,
+                                        message_id=self.id, content=content)
+        message = self.channel.messages.get(self.id)
+        if message is not None:
+            message.content = content
+        return message
+
+    async def delete(self):
+        await self.channel.http.request("DELETE", f"/channels/{self.channel.id}/messages/{self.id}", self.channel.id,
+                                        message_id=self.id)
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    def __init__(self, http, id, name, guild, bot_user):
+        self.http = http
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.bot_user = bot_user
+        # every message posted in this channel, by users and by the bot
+        self.messages = {}
+
+    async def send(self, content=None, reference=None, embed=None, allowed_mentions=None, file=None, files=None,
+                   **kwargs):
+        files = files or ([file] if file else [])
+        recorded = await self.http.request("POST", f"/channels/{self.id}/messages", self.id, content=content,
+                                           reference=reference and reference.message_id,
+                                           files=[f.filename for f in files])
+        for f in files:
+            f.close()
+        message = FakeMessage(self.http.next_id(), self, self.bot_user, content)
+        recorded["id"] = message.id
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, id):
+        return FakePartialMessage(self, id)
+
+    async def fetch_message(self, id):
+        await self.http.request("GET", f"/channels/{self.id}/messages/{id}", self.id, message_id=id)
+        return self.messages[id]
+
+    async def delete_messages(self, messages):
+        ids = [message.id for message in messages]
+        await self.http.request("POST", f"/channels/{self.id}/messages/bulk-delete", self.id, message_ids=ids)
+        for id in ids:
+            self.messages.pop(id, None)
+
+    async def history(self, limit=100, after=None, oldest_first=None, **kwargs):
+        after = after.id if after else 0
+        for id in sorted(self.messages)[:limit]:
+            if id > after:
+                yield self.messages[id]
+
+
+class FakePartialMessageable:
+    """What get_partial_messageable returns: it sends and reaches messages by id, but can't bulk delete."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.id = channel.id
+        self.guild = channel.guild
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def get_partial_message(self, id):
+        return FakePartialMessage(self.channel, id)
+
+    async def fetch_message(self, id):
+        return await self.channel.fetch_message(id)
+
+
+class FakeBot:
+    """
+    Enough of commands.Bot for the Bridge cog. Every channel is reachable through
+    get_partial_messageable (REST works for any channel), get_channel only returns
+    channels whose guild is cached by this process, i.e. is on one of its shards.
+    """
+
+    def __init__(self, http, topology, is_local=lambda guild_id: True):
+        self.http = http
+        self.user = FakeUser(1, "Bridge Bot", bot=True)
+        self._connection = None
+        self.is_local = is_local
+        self.channels = {}
+        for channel in topology["channels"]:
+            guild = FakeGuild(channel["guild_id"], channel["guild_name"])
+            self.channels[channel["id"]] = FakeChannel(http, channel["id"], channel["name"], guild, self.user)
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    def is_ready(self):
+        return True
+
+    async def wait_until_ready(self):
+        return
+
+    def get_channel(self, id):
+        channel = self.channels.get(id)
+        if channel is None or not self.is_local(channel.guild.id):
+            return None
+        return channel
+
+    def get_partial_messageable(self, id, guild_id=None, **kwargs):
+        return FakePartialMessageable(self.channels[id])
+
+
+class FakeGateway:
+    """Synthetic bridges over one channel per guild, and user traffic on them."""
+
+    def __init__(self, bridges=2, channels_per_bridge=3, unbridged_channels=0, seed=0):
+        self.rng = random.Random(seed)
+        self.message_ids = itertools.count(10 ** 17)
+        self.users = [FakeUser(1000 + i, f"user{i}") for i in range(20)]
+        channels = []
+        bridge_docs = []
+        for bridge in range(bridges + 1):
+            count = channels_per_bridge if bridge < bridges else unbridged_channels
+            ids = []
+            for _ in range(count):
+                guild_id = (self.rng.randrange(1 << 20) << 22) | len(channels)
+                channel_id = (self.rng.randrange(1 << 20) << 22) | (len(channels) + 1 << 12)
+                channels.append({
+                    "id"        : channel_id,
+                    "name"      : f"channel-{len(channels)}",
+                    "guild_id"  : guild_id,
+                    "guild_name": f"guild-{len(channels)}"
+                })
+                ids.append(channel_id)
+            if bridge < bridges:
+                bridge_docs.append({"name": f"bridge-{bridge}", "channels": ids})
+        self.topology = {"channels": channels, "bridges": bridge_docs}
+        self.guilds = {channel["id"]: channel["guild_id"] for channel in channels}
+
+    def events(self, count, edit_ratio=0.1, delete_ratio=0.05, reply_ratio=0.1):
+        """Yield picklable event dicts, edits and deletes always target earlier messages."""
+        live = {}
+        channel_ids = list(self.guilds)
+        for _ in range(count):
+            roll = self.rng.random()
+            channel_id = self.rng.choice(channel_ids)
+            messages = live.setdefault(channel_id, [])
+            event = {"channel_id": channel_id, "guild_id": self.guilds[channel_id], "sent_at": None}
+            if messages and roll < delete_ratio:
+                event.update(type="delete", message_id=messages.pop(self.rng.randrange(len(messages))))
+            elif messages and roll < delete_ratio + edit_ratio:
+                message_id = self.rng.choice(messages)
+                event.update(type="edit", message_id=message_id, content=f"msg {message_id} edited {self.rng.random():.3f}")
+            else:
+                message_id = next(self.message_ids)
+                reference = self.rng.choice(messages) if messages and self.rng.random() < reply_ratio else None
+                messages.append(message_id)
+                event.update(type="new", message_id=message_id, content=f"msg {message_id}",
+                             author_id=self.rng.choice(self.users).id, reference=reference)
+            yield event
+
+
+async def dispatch(cog, bot, event):
+    """Feed one gateway event to the cog's listeners the way discord.py would."""
+    channel = bot.channels[event["channel_id"]]
+    match event["type"]:
+        case "new":
+            author = FakeUser(event["author_id"], f"user{event['author_id']}")
+            message = FakeMessage(event["message_id"], channel, author, event["content"], reference=event.get("reference"))
+            channel.messages[message.id] = message
+            await cog.on_message(message)
+        case "edit":
+            old = channel.messages.get(event["message_id"])
+            if old is None:
+                return
+            message = FakeMessage(old.id, channel, old.author, event["content"])
+            channel.messages[message.id] = message
+            await cog.on_raw_message_edit(SimpleNamespace(
+                channel_id=channel.id, guild_id=channel.guild.id, message_id=message.id,
+                data={"author": {"id": str(message.author.id)}}, message=message, cached_message=old
+            ))
+        case "delete":
+            channel.messages.pop(event["message_id"], None)
+            await cog.on_raw_message_delete(SimpleNamespace(
+                channel_id=channel.id, guild_id=channel.guild.id, message_id=event["message_id"], cached_message=None
+            ))
+
+
+async def wait_idle(cog, settle=1.0):
+    """Wait until nothing is queued, held back, forwarded or unacknowledged for a while."""
+    quiet_since = None
+    while True:
+        busy = any((
+            any(q.qsize() for q in cog.bridge_queues.values()),
+            cog.scheduler.depth(),
+            cog.coalescer.edits,
+            cog.forwarder and cog.forwarder.pending,
+            cog.outbox.pending()
+        ))
+        if busy:
+            quiet_since = None
+        elif quiet_since is None:
+            quiet_since = time.monotonic()
+        elif time.monotonic() - quiet_since > settle:
+            return
+        await asyncio.sleep(0.05)
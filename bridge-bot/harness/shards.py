@@ -0,0 +1,195 @@
+"""
+Runs the Bridge cog in several worker processes against a fake gateway and a real MongoDB,
+the way a sharded deployment would, and checks every message reached every other channel
+of its bridge exactly once, and that edits and deletes followed every copy.
+
+Each worker only "sees" (has in its cache) the guilds of its own shards, the gateway hands
+every event to the worker owning the source guild's shard. Bridges are spread over the
+workers by the leases in the db, so most payloads cross a process boundary on their way.
+
+Run from the bridge-bot folder, with a main.cfg pointing at a throwaway MongoDB:
+
+    python -m harness.shards --workers 3 --bridges 6 --messages 2000
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import queue
+import re
+import sys
+import time
+
+DB_NAME = "bridge_harness"
+
+
+async def run_worker(index, shard_ids, shard_count, topology, args, events, results):
+    import motor.motor_asyncio
+    from harness.fake import FakeBot, FakeHTTP, dispatch, shard_of, wait_idle
+    from plugins.bridge.bridge import Bridge
+    from utils.cfg import cfg
+
+    http = FakeHTTP(id_base=(index + 2) * 10 ** 17 + 10 ** 16, latency=args.latency)
+    bot = FakeBot(http, topology, is_local=lambda guild_id: shard_of(guild_id, shard_count) in shard_ids)
+    mongo = motor.motor_asyncio.AsyncIOMotorClient(cfg["mongodb_uri"])
+    cog = Bridge(bot, db=mongo[DB_NAME])
+    cog.enable_workers(f"worker-{index}", lease_ttl=args.lease_ttl, forward_interval=0.1)
+    await cog.cog_load()
+    await cog.start()
+    # give every worker a chance to take its share of the leases before traffic starts
+    await asyncio.sleep(args.lease_ttl)
+    results.put(("ready", index, sorted(cog.leases.owned)))
+
+    loop = asyncio.get_running_loop()
+    handled = 0
+    while True:
+        event = await loop.run_in_executor(None, events.get)
+        if event is None:
+            break
+        await dispatch(cog, bot, event)
+        handled += 1
+    await wait_idle(cog)
+    results.put(("idle", index, None))
+    # payloads other workers forward to us may still be on their way, drain once more
+    await loop.run_in_executor(None, events.get)
+    await wait_idle(cog)
+    owned = sorted(cog.leases.owned)
+    await cog.cog_unload()
+    posts, patches, deletes = [], [], []
+    for method, route, channel_id, payload, at in http.calls:
+        if method == "POST" and route == "/channels/{id}/messages":
+            if match := re.search(r"msg (\d+)", payload.get("content") or ""):
+                posts.append((channel_id, payload["id"], int(match.group(1)), payload["content"], at))
+        elif method == "PATCH":
+            patches.append((channel_id, payload["message_id"], payload["content"], at))
+        elif method == "DELETE":
+            deletes.append((channel_id, payload["message_id"]))
+    results.put(("done", index, {
+        "events"   : handled,
+        "owned"    : owned,
+        "calls"    : collections.Counter(f"{call[0]} {call[1]}" for call in http.calls),
+        "posts"    : posts,
+        "patches"  : patches,
+        "deletes"  : deletes,
+        "coalesced": cog.coalescer.coalesced,
+        "pending"  : len(cog.coalescer.sends)
+    }))
+
+
+def worker(*args):
+    logging.basicConfig(level=logging.WARNING, format=f"%(asctime)s worker-{args[0]} %(name)s: %(message)s")
+    asyncio.run(run_worker(*args))
+
+
+async def prepare(gateway):
+    import motor.motor_asyncio
+    from utils.cfg import cfg
+
+    mongo = motor.motor_asyncio.AsyncIOMotorClient(cfg["mongodb_uri"])
+    await mongo.drop_database(DB_NAME)
+    await mongo[DB_NAME].bridges.insert_many([dict(bridge) for bridge in gateway.topology["bridges"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--shards", type=int, default=6)
+    parser.add_argument("--bridges", type=int, default=6)
+    parser.add_argument("--channels", type=int, default=3, help="channels per bridge")
+    parser.add_argument("--messages", type=int, default=1000, help="gateway events to generate")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake REST latency in seconds")
+    parser.add_argument("--lease-ttl", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from harness.fake import FakeGateway, shard_of
+
+    gateway = FakeGateway(bridges=args.bridges, channels_per_bridge=args.channels, seed=args.seed)
+    asyncio.run(prepare(gateway))
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    inboxes = []
+    processes = []
+    for index in range(args.workers):
+        shard_ids = [shard for shard in range(args.shards) if shard % args.workers == index]
+        inbox = context.Queue()
+        process = context.Process(
+            target=worker,
+            args=(index, shard_ids, args.shards, gateway.topology, args, inbox, results)
+        )
+        process.start()
+        inboxes.append(inbox)
+        processes.append(process)
+
+    for _ in processes:
+        _, index, owned = results.get(timeout=60)
+        print(f"worker-{index} ready, drives {owned}")
+
+    events = list(gateway.events(args.messages))
+    started = time.monotonic()
+    for event in events:
+        shard = shard_of(event["guild_id"], args.shards)
+        inboxes[shard % args.workers].put(event)
+    for inbox in inboxes:
+        inbox.put(None)
+    for _ in processes:
+        results.get(timeout=300)
+    for inbox in inboxes:
+        inbox.put(None)
+
+    reports = {}
+    for _ in processes:
+        try:
+            _, index, report = results.get(timeout=300)
+        except queue.Empty:
+            print("Timed out waiting for the workers")
+            sys.exit(1)
+        reports[index] = report
+    elapsed = time.monotonic() - started
+    for process in processes:
+        process.join()
+
+    # every message that was never deleted must reach each other channel of its bridge exactly once
+    bridge_of = {channel_id: bridge["channels"] for bridge in gateway.topology["bridges"] for channel_id in bridge["channels"]}
+    deleted = {event["message_id"] for event in events if event["type"] == "delete"}
+    expected = collections.Counter(
+        (target, event["message_id"])
+        for event in events if event["type"] == "new"
+        for target in bridge_of.get(event["channel_id"], ()) if target != event["channel_id"]
+    )
+    posts = [post for report in reports.values() for post in report["posts"]]
+    delivered = collections.Counter((channel_id, source_id) for channel_id, _, source_id, _, _ in posts)
+    duplicates = {key: count for key, count in delivered.items() if count > 1}
+    missing = [key for key in expected if key not in delivered and key[1] not in deleted]
+    unexpected = [key for key in delivered if key not in expected]
+
+    # every copy of a deleted message is deleted, every other copy shows the last edit
+    deletes = {delete for report in reports.values() for delete in report["deletes"]}
+    last_edit = {event["message_id"]: event["content"] for event in events if event["type"] == "edit"}
+    latest = {bridged_id: (at, content) for _, bridged_id, _, content, at in posts}
+    for _, bridged_id, content, at in sorted((patch for report in reports.values() for patch in report["patches"]),
+                                             key=lambda patch: patch[3]):
+        if bridged_id in latest:
+            latest[bridged_id] = (at, content)
+    undeleted = [post for post in posts if post[2] in deleted and (post[0], post[1]) not in deletes]
+    stale = [
+        post for post in posts
+        if post[2] not in deleted and post[2] in last_edit and last_edit[post[2]] not in latest[post[1]][1]
+    ]
+    # sends still tracked by the coalescer once everything went out would swallow later edits
+    leaked = sum(report["pending"] for report in reports.values())
+
+    for index, report in sorted(reports.items()):
+        print(f"worker-{index}: {report['events']} events, drives {report['owned']}, "
+              f"coalesced {report['coalesced']}, calls {dict(report['calls'])}")
+    print(f"{len(events)} events in {elapsed:.2f}s, {sum(delivered.values())} sends, "
+          f"{len(duplicates)} duplicated, {len(missing)} missing, {len(unexpected)} unexpected, "
+          f"{len(undeleted)} not deleted, {len(stale)} without their last edit, {leaked} sends left in the coalescer")
+    if duplicates or missing or unexpected or undeleted or stale or leaked:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
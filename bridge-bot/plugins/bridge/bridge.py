@@ -1,56 +1,365 @@
 import asyncio
+import functools
 import logging
+import os
+import socket
+import time
+from typing import Literal
 
-import motor.motor_asyncio
-from discord import Embed, AllowedMentions, NotFound
+from pymongo.errors import OperationFailure
+from discord import AllowedMentions, Message, NotFound, Forbidden, HTTPException
 # import "app_commands" and only "app_commands"
 from discord import app_commands
 from discord.ext import commands
-from checksumdir import dirhash
+from discord.webhook.async_ import async_context
 from discord import Object
 
 from utils.cfg import cfg
+from utils.attachments import AttachmentStore
+from utils.coalesce import EventCoalescer
+from utils.flood import FloodGuard
+from utils.mapping import MessageMappings
+from utils.metrics import BridgeCollector, metrics
+from utils.outbox import Outbox
+from utils.render import RenderCache, unchanged
 from utils.reporter import report_error
+from utils.routing import compile_routes
+from utils.scheduler import FanoutScheduler, RateLimitListener
+from utils.snapshot import MessageSnapshot
+from utils.startup import startup
+from utils.webhooks import WebhookPool
+from utils.workers import Forwarder, LeaseManager
 
 log = logging.getLogger(__name__)
 log.setLevel(cfg["log_level"])
 
 
 class Bridge(commands.Cog):
-    def __init__(self, bot):
+    # fields of a bridge document the routing index is built from
+    ROUTING_FIELDS = {"name": 1, "channels": 1, "edges": 1, "modes": 1}
+
+    def __init__(self, bot, db=None):
         self.bot = bot
-        self.mongo = motor.motor_asyncio.AsyncIOMotorClient(cfg["mongodb_uri"])
-        self.db = self.mongo.bridge
+        if cfg.get("bridge.metrics.port", 0):
+            metrics.start(cfg["bridge.metrics.port"], cfg.get("bridge.metrics.addr", "0.0.0.0"))
+        # the harness passes its own database, the bot shares one client between all plugins
+        self.db = db if db is not None else bot.mongo.bridge
+        compact = cfg.get("bridge.mappings.layout", "default") == "compact"
+        ttl_days = cfg.get("bridge.mappings.ttl_days", 0)
+        self.mappings = MessageMappings(
+            self.db.compact_messages if compact else self.db.messages,
+            flush_size=cfg.get("bridge.mappings.flush_size", 100),
+            flush_interval=cfg.get("bridge.mappings.flush_interval", 2),
+            compact=compact,
+            ttl=ttl_days * 24 * 60 * 60 if ttl_days else None,
+            cache_size=cfg.get("bridge.mappings.cache_size", 10000)
+        )
+        self.outbox = Outbox(
+            self.db.outbox,
+            self.db.cursors,
+            flush_interval=cfg.get("bridge.outbox.flush_interval", 1),
+            mappings=self.mappings
+        )
+        # only set when messages should be delivered through per-channel webhooks
+        self.webhooks = None
+        if cfg.get("bridge.delivery", "bot") == "webhook":
+            self.webhooks = WebhookPool(bot, self.db.webhooks)
+        self.scheduler = FanoutScheduler(
+            concurrency=cfg.get("bridge.scheduler.concurrency", 50),
+            rate=cfg.get("bridge.scheduler.rate", 1),
+            burst=cfg.get("bridge.scheduler.burst", 5),
+            max_queue=cfg.get("bridge.scheduler.max_queue", 500)
+        )
+        self.rate_limits = RateLimitListener(
+            self.scheduler.rate_limited,
+            self.webhooks.channel_of if self.webhooks else None,
+            observer=metrics.rate_limited
+        )
+        self.collector = BridgeCollector(self)
+        # only set when attachments are re-uploaded to every target instead of linked
+        self.attachments = None
+        if cfg.get("bridge.attachments.mode", "link") == "upload":
+            self.attachments = AttachmentStore(
+                cfg.get("bridge.attachments.cache_dir", "attachments"),
+                max_cache_size=cfg.get("bridge.attachments.cache_size_mb", 1024) * 1024 * 1024,
+                max_file_size=cfg.get("bridge.attachments.max_size_mb", 100) * 1024 * 1024,
+                concurrency=cfg.get("bridge.attachments.concurrency", 4)
+            )
+        # renderings shared by all targets of a payload
+        self.renders = RenderCache(
+            cfg.get("bridge.render_cache_size", 1000),
+            link_attachments=self.attachments is None
+        )
+        self.coalescer = EventCoalescer(
+            self.enqueue,
+            window=cfg.get("bridge.edit_window", 1)
+        )
+        # only set when flood protection is enabled
+        self.flood = None
+        # new messages waiting in a bridge queue beyond this go into their channel's digest
+        self.max_queue = cfg.get("bridge.flood.max_queue", 1000)
+        if cfg.get("bridge.flood.enabled", False):
+            self.flood = FloodGuard(
+                self.enqueue_digest,
+                self.backlog,
+                channel_rate=cfg.get("bridge.flood.channel_rate", 3),
+                channel_burst=cfg.get("bridge.flood.channel_burst", 15),
+                author_rate=cfg.get("bridge.flood.author_rate", 1),
+                author_burst=cfg.get("bridge.flood.author_burst", 8),
+                max_backlog=cfg.get("bridge.flood.max_backlog", 50),
+                digest_interval=cfg.get("bridge.flood.digest_interval", 10),
+                digest_size=cfg.get("bridge.flood.digest_size", 20)
+            )
+        # only set when several worker processes share the bridges
+        self.leases = None
+        self.forwarder = None
+        if cfg.get("bridge.workers.enabled", False):
+            self.enable_workers(
+                os.environ.get("BRIDGE_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}",
+                lease_ttl=cfg.get("bridge.workers.lease_ttl", 30),
+                forward_interval=cfg.get("bridge.workers.forward_interval", 0.25)
+            )
         self.bridge_names = []
         self.bridge_queues = {}
         self.bridge_tasks = {}
         self.bridge_logs = {}
+        # channel_id -> bridge name, used to drop unbridged traffic without touching the db
+        self.channel_bridges = {}
+        # bridge name -> channel ids, read by the fan-out path instead of the db
+        self.bridge_channels = {}
+        # bridge name -> compiled routing table, see utils.routing
+        self.routes = {}
+        self.watch_task = None
+        self.warm_task = None
         self.ran = False
 
+    def enable_workers(self, worker_id, lease_ttl=30, forward_interval=0.25):
+        self.leases = LeaseManager(
+            self.db.leases,
+            self.db.workers,
+            worker_id,
+            ttl=lease_ttl,
+            on_acquire=self.recover
+        )
+        self.forwarder = Forwarder(
+            self.db.forwarded,
+            self.leases,
+            self.receive_forwarded,
+            interval=forward_interval
+        )
+
+    async def cog_load(self):
+        self.rate_limits.attach()
+        if metrics.enabled:
+            metrics.instrument(self.bot.http)
+            metrics.instrument(async_context.get())
+            metrics.register(self.collector)
+        self.mappings.start()
+        self.outbox.start()
+        if self.flood:
+            self.flood.start()
+        # cogs are loaded before the gateway connects, don't hold the connect up with db round trips
+        self.warm_task = asyncio.get_running_loop().create_task(self.warm())
+
+    async def warm(self):
+        # nothing here needs the gateway, the bridge loops only start delivering once the bot is ready
+        with startup.phase("bridge warm-up"):
+            try:
+                await self.mappings.ensure_indexes()
+            except Exception as err:
+                log.error(f"Failed to ensure message mapping indexes: {err}")
+            if self.webhooks:
+                await self.webhooks.load()
+            await self.maintenance()
+
+    async def cog_unload(self):
+        if self.warm_task:
+            self.warm_task.cancel()
+        if self.watch_task:
+            self.watch_task.cancel()
+        for task in self.bridge_tasks.values():
+            task.cancel()
+        if self.leases:
+            await self.forwarder.close()
+            await self.leases.close()
+        self.rate_limits.detach()
+        metrics.unregister(self.collector)
+        if self.flood:
+            await self.flood.close()
+        await self.scheduler.close()
+        if self.attachments:
+            await self.attachments.close()
+        # write out buffered state before the cog goes away, unacknowledged deliveries resume on next start
+        await self.outbox.close()
+        await self.mappings.close()
+
     @commands.Cog.listener()
     async def on_ready(self):
         if self.ran:
             return
         self.ran = True
-        log.info("Checking if plugins have changed!")
-        plugins_hash = dirhash("plugins")
-        log.debug(f"Plugin folder hash: {plugins_hash}")
-        # check if hash in db matches
-        db_entry = await self.db.state.find_one({"_id": "plugins_hash"})
-        if db_entry and plugins_hash == db_entry.get("hash"):
-            log.info("Plugins have not changed!")
+        with startup.phase("bridge start"):
+            await self.start()
+
+    async def start(self):
+        if self.warm_task is None:
+            await self.maintenance()
         else:
-            log.info("Plugins have changed! Updating Commands...")
-            await self.bot.tree.sync()
-            await self.db.state.update_one({"_id": "plugins_hash"}, {"$set": {"hash": plugins_hash}}, upsert=True)
-            log.info("Commands updated!")
-        await self.maintenance()
+            # usually done while the gateway connected
+            await self.warm_task
+        self.watch_task = self.bot.loop.create_task(self.watch_bridges())
+        if self.leases:
+            # pending deliveries are resumed per bridge as its lease is acquired
+            self.leases.start()
+            self.forwarder.start()
+        else:
+            await self.recover()
+        self.bot.loop.create_task(self.backfill())
+
+    def get_target(self, channel_id):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None and self.leases:
+            # the target's guild may be on another worker's shard, sending only needs the id
+            channel = self.bot.get_partial_messageable(channel_id)
+        return channel
+
+    def owns(self, bridge_name):
+        return self.leases is None or self.leases.owns(bridge_name)
+
+    def receive_forwarded(self, bridge_name, doc):
+        # payload of a bridge we drive, picked up by a worker that sees the source channel
+        if doc["type"] in ("new_message", "edited_message"):
+            payload = {"type": doc["type"], "message": MessageSnapshot(doc["message"])}
+        elif doc["type"] == "deleted_message":
+            channel = self.bot.get_partial_messageable(doc["channel_id"])
+            payload = {"type": doc["type"], "message": channel.get_partial_message(doc["message_ids"][0])}
+        elif doc["type"] == "digest":
+            payload = {"type": doc["type"], "channel_id": doc["channel_id"], "content": doc["content"]}
+        else:
+            payload = {"type": doc["type"], "channel_id": doc["channel_id"], "message_ids": doc["message_ids"]}
+        if doc.get("replay"):
+            payload["replay"] = True
+        match doc["type"]:
+            case "new_message":
+                self.coalescer.new_message(bridge_name, payload)
+            case "deleted_message":
+                self.coalescer.deleted_message(bridge_name, payload)
+            case "bulk_deleted_messages":
+                self.coalescer.bulk_deleted_messages(bridge_name, payload)
+            case _:
+                self.enqueue(bridge_name, payload)
+
+    async def recover(self, bridge_names=None):
+        # resume deliveries that were still pending when the bot, or the worker driving them, went down
+        docs = await self.outbox.load(bridge_names)
+        for doc in docs:
+            if doc["_id"] in self.outbox.remaining:
+                # still being delivered by this worker
+                continue
+            if doc["bridge"] not in self.bridge_queues or not doc["targets"]:
+                self.outbox.discard(doc["_id"])
+                continue
+            try:
+                payload = await self.rebuild_payload(doc)
+            except HTTPException as err:
+                log.warning(f"Failed to rebuild {doc['type']} payload {doc['_id']}: {err}")
+                payload = None
+            if payload is None:
+                self.outbox.discard(doc["_id"])
+                continue
+            self.outbox.resume(payload, doc)
+            if payload["type"] == "new_message":
+                self.coalescer.new_message(doc["bridge"], payload)
+            else:
+                self.enqueue(doc["bridge"], payload)
+        if docs:
+            log.info(f"Resumed {len(docs)} pending deliveries")
+
+    async def rebuild_payload(self, doc):
+        channel = self.bot.get_channel(doc["channel_id"]) or self.bot.get_partial_messageable(doc["channel_id"])
+        match doc["type"]:
+            case "new_message" | "edited_message" if "message" in doc:
+                payload = {"type": doc["type"], "message": MessageSnapshot(doc["message"])}
+            case "new_message" | "edited_message":
+                try:
+                    message = await channel.fetch_message(doc["message_ids"][0])
+                except NotFound:
+                    # deleted in the meantime, nothing left to bridge
+                    return None
+                payload = {"type": doc["type"], "message": message}
+            case "deleted_message":
+                payload = {"type": doc["type"], "message": channel.get_partial_message(doc["message_ids"][0])}
+            case "bulk_deleted_messages":
+                payload = {"type": doc["type"], "channel_id": doc["channel_id"], "message_ids": doc["message_ids"]}
+            case _:
+                return None
+        payload["targets"] = doc["targets"]
+        payload["replay"] = True
+        return payload
+
+    async def backfill(self):
+        # catch up on messages posted while the bot was offline, the mapping store filters out the ones
+        # already delivered, except those delivered within the last outbox flush before a crash
+        limit = cfg.get("bridge.backfill_limit", 100)
+        cursors = await self.outbox.load_cursors(self.channel_bridges)
+        for channel_id, after in cursors.items():
+            bridge_name = self.channel_bridges.get(channel_id)
+            channel = self.bot.get_channel(channel_id)
+            if bridge_name is None or channel is None:
+                continue
+            count = 0
+            try:
+                async for message in channel.history(after=Object(id=after), oldest_first=True, limit=limit):
+                    if message.author == self.bot.user:
+                        continue
+                    if message.webhook_id and self.webhooks and await self.webhooks.is_own(
+                            message.webhook_id, getattr(message, "application_id", None)):
+                        continue
+                    self.coalescer.new_message(bridge_name, {"type": "new_message", "message": message, "replay": True})
+                    count += 1
+            except HTTPException as err:
+                log.warning(f"Failed to backfill channel {channel_id}: {err}")
+            if count:
+                log.info(f"Backfilled {count} messages from channel {channel_id} for Bridge {bridge_name}")
+
+    async def watch_bridges(self):
+        # keep the routing index in sync with edits made outside of this process
+        interval = cfg.get("bridge.reload_interval", 60)
+        reconnecting = False
+        while True:
+            try:
+                async with self.db.bridges.watch() as stream:
+                    log.info("Watching bridges collection for changes")
+                    if reconnecting:
+                        # pick up whatever changed while the stream was down
+                        await self.maintenance()
+                    async for _ in stream:
+                        await self.maintenance()
+            except OperationFailure:
+                # change streams need a replica set
+                break
+            except Exception as err:
+                # network errors and failed reloads, don't let the routing index go stale
+                report_error(err)
+                log.warning(f"Watching bridges failed, retrying in {interval}s")
+                await asyncio.sleep(interval)
+                reconnecting = True
+        log.info(f"Change streams unavailable, reloading bridges every {interval}s")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.maintenance()
+            except Exception as err:
+                report_error(err)
 
     async def maintenance(self):
-        all_bridges = await self.db.bridges.distinct("name")
+        bridges = await self.db.bridges.find({}, self.ROUTING_FIELDS).to_list(length=None)
+        all_bridges = [bridge["name"] for bridge in bridges]
+        if self.leases:
+            self.leases.set_names(all_bridges)
         # create task for each bridge
         # kill all tasks that are not in the bridge_names list
-        for bridge in self.bridge_names:
+        for bridge in list(self.bridge_names):
             if bridge not in all_bridges:
                 self.bridge_tasks[bridge].cancel()
                 del self.bridge_tasks[bridge]
@@ -67,29 +376,144 @@ class Bridge(commands.Cog):
                 self.bridge_logs[bridge] = logging.getLogger(f"bridge-{bridge}")
                 self.bridge_logs[bridge].setLevel(cfg["log_level"])
                 log.info(f"Bridge {bridge} Task created!")
+        # rebuild the routing index in one go so listeners never see a half-built one
+        self.bridge_channels = {bridge["name"]: tuple(bridge["channels"]) for bridge in bridges}
+        self.routes = {bridge["name"]: compile_routes(bridge) for bridge in bridges}
+        # only channels that send anywhere, traffic in read-only channels is dropped right away
+        self.channel_bridges = {
+            channel_id: bridge_name
+            for bridge_name, routes in self.routes.items()
+            for channel_id in routes
+        }
+
+    async def refresh_bridge(self, bridge_name):
+        # explicitly invalidate the cached channel list of one bridge after its membership changed
+        bridge = await self.db.bridges.find_one({"name": bridge_name}, self.ROUTING_FIELDS)
+        channel_bridges = {k: v for k, v in self.channel_bridges.items() if v != bridge_name}
+        if bridge is None:
+            self.bridge_channels.pop(bridge_name, None)
+            self.routes.pop(bridge_name, None)
+        else:
+            self.bridge_channels[bridge_name] = tuple(bridge["channels"])
+            routes = self.routes[bridge_name] = compile_routes(bridge)
+            channel_bridges.update((channel_id, bridge_name) for channel_id in routes)
+        self.channel_bridges = channel_bridges
+
+    def route(self, bridge_name, payload, source_channel):
+        routes = self.routes.get(bridge_name, {}).get(source_channel, ())
+        match payload["type"]:
+            case "new_message":
+                message = payload["message"]
+                return [target for target, edge_filter in routes if edge_filter is None or edge_filter.allows(message)]
+            case "digest":
+                # a digest can't be checked against edge filters, filtered edges get nothing
+                return [target for target, edge_filter in routes if edge_filter is None]
+            case "bulk_deleted_messages":
+                message_ids = payload["message_ids"]
+            case _ if payload["message"].id in self.coalescer.sends:
+                # the send may not have stored its mappings yet, the per-target queues keep the order
+                return [target for target, _ in routes]
+            case _:
+                message_ids = [payload["message"].id]
+        # edits and deletes only go where the message was bridged to, filtered edges included.
+        # Only memory is asked here, targets it can't rule out get the payload and look it up
+        # themselves, the handlers skip targets without a mapping
+        targets = [target for target, _ in routes]
+        mapped = set()
+        for message_id in message_ids:
+            cached = self.mappings.cached_targets(message_id, targets)
+            if cached is None:
+                return targets
+            mapped.update(cached)
+        return [target for target in targets if target in mapped]
+
+    def enqueue(self, bridge_name, payload):
+        if not self.owns(bridge_name):
+            # another worker drives this bridge, hand the payload over through the db
+            self.forwarder.forward(bridge_name, payload)
+            if payload["type"] == "new_message":
+                # the owner coalesces it, a send left here would swallow later edits and deletes
+                self.coalescer.abandon(payload)
+            return
+        queue = self.bridge_queues.get(bridge_name)
+        if queue is None:
+            log.warning(f"Bridge {bridge_name} is gone, dropping {payload['type']} payload")
+            return
+        if self.flood and payload["type"] == "new_message" and not payload.get("replay") and queue.qsize() >= self.max_queue:
+            # overflow policy: live new messages are merged into a digest, everything else is always queued
+            self.coalescer.abandon(payload)
+            self.flood.overflow(bridge_name, payload["message"])
+            # don't let the backfill replay it one by one after a restart
+            self.outbox.advance(payload["message"].channel.id, payload["message"].id)
+            return
+        payload["queued_at"] = time.monotonic()
+        queue.put_nowait(payload)
+
+    def enqueue_digest(self, bridge_name, channel_id, content):
+        self.enqueue(bridge_name, {"type": "digest", "channel_id": channel_id, "content": content})
+
+    def backlog(self, bridge_name, channel_id):
+        # longest target queue of a source channel, only covers targets driven by this worker
+        routes = self.routes.get(bridge_name, {}).get(channel_id, ())
+        return max((self.scheduler.depth(target) for target, _ in routes), default=0)
 
     async def handle_event(self, func, payload, channel_id, bridge_name):
         l = self.bridge_logs[bridge_name]
+        new_message = payload["type"] == "new_message"
+        if new_message and not self.coalescer.begin(payload):
+            l.debug("Send of message %s to %s cancelled", payload["message"].id, channel_id)
+            self.outbox.ack(payload, channel_id)
+            return
+        if payload["type"] == "bulk_deleted_messages":
+            args = {"mappings": None}
+            subject, subject_arg = "%s messages", len(payload["message_ids"])
+        elif payload["type"] == "digest":
+            args = {"content": payload["content"]}
+            subject, subject_arg = "digest of channel %s", payload["channel_id"]
+        else:
+            args = {"message": payload["message"]}
+            subject, subject_arg = "message %s", payload["message"].id
         try:
-            await func(
-                target_channel=channel_id,
-                message=payload["message"],
-                bridge_name=bridge_name
-            )
-            l.debug(f"{func.__name__} on message {payload['message'].id} bridged to {channel_id}")
+            if payload["type"] == "bulk_deleted_messages":
+                args["mappings"] = await self.bulk_mappings(payload)
+            if new_message and payload.get("replay") and await self.mappings.find(payload["message"].id, channel_id):
+                # delivered before the restart already
+                l.debug(subject + " already bridged to %s", subject_arg, channel_id)
+            else:
+                await func(
+                    target_channel=channel_id,
+                    bridge_name=bridge_name,
+                    **args
+                )
+                metrics.delivered(payload["type"], payload.get("queued_at"))
+                l.debug("%s on " + subject + " bridged to %s", func.__name__, subject_arg, channel_id)
         except Exception as e:
-            await report_error(e)
+            report_error(e)
             l.error(f"Error: {e}")
+        finally:
+            if new_message:
+                self.coalescer.finish(payload)
+        # not reached when the delivery gets cancelled, so it is resumed on the next start
+        self.outbox.ack(payload, channel_id)
+
+    def bulk_mappings(self, payload):
+        # the mappings of every deleted message, read once by the first target and shared with the others
+        lookup = payload.get("lookup")
+        if lookup is None:
+            lookup = payload["lookup"] = asyncio.ensure_future(self.mappings.find_many(payload["message_ids"]))
+        return asyncio.shield(lookup)
 
     async def bridge_loop(self, bridge_name):
         l = self.bridge_logs[bridge_name]
         l.info(f"Task started!")
+        # targets are looked up in the guild cache, which is only complete once the bot is ready
+        await self.bot.wait_until_ready()
         while True:
             try:
-                l.debug(f"Waiting for messages...")
+                l.debug("Waiting for messages...")
                 payload = await self.bridge_queues[bridge_name].get()
-                l.debug(f"Hot new payload!")
-                bridge = await self.db.bridges.find_one({"name": bridge_name})
+                l.debug("Hot new payload!")
+                channels = self.bridge_channels.get(bridge_name, ())
                 match payload["type"]:
                     case "new_message":
                         func = self.handle_new_message
@@ -97,186 +521,327 @@ class Bridge(commands.Cog):
                         func = self.handle_edited_message
                     case "deleted_message":
                         func = self.handle_deleted_message
+                    case "bulk_deleted_messages":
+                        func = self.handle_bulk_deleted_messages
+                    case "digest":
+                        func = self.handle_digest
                     case _:
                         log.error(f"Bridge {bridge_name} unknown payload type!")
-                        return
-                # generate a async task for each channel
-                tasks = [
-                    self.bot.loop.create_task(
-                        self.handle_event(func, payload, channel_id, bridge_name)
-                    )
-                    for channel_id in bridge["channels"] if channel_id != payload["message"].channel.id
-                ]
-                await asyncio.gather(*tasks)
-                l.debug(f"Finished handling payload!")
+                        continue
+                if payload.get("cancelled"):
+                    l.debug("Payload cancelled before dispatch")
+                    continue
+                # hand the payload to each target's queue, a slow target doesn't hold up the others
+                with metrics.span("route"):
+                    source_channel = payload["channel_id"] if "channel_id" in payload else payload["message"].channel.id
+                    if "outbox_id" in payload:
+                        # resumed from the outbox, only the targets that never acknowledged it
+                        targets = [channel_id for channel_id in payload["targets"] if channel_id in channels]
+                        for channel_id in set(payload["targets"]).difference(targets):
+                            # disconnected in the meantime
+                            self.outbox.ack(payload, channel_id)
+                    else:
+                        targets = self.route(bridge_name, payload, source_channel)
+                        self.outbox.record(bridge_name, payload, source_channel, targets)
+                    if payload["type"] == "new_message":
+                        self.coalescer.dispatch(payload, len(targets))
+                    new_message = payload["type"] == "new_message"
+                    for channel_id in targets:
+                        # overflow policy: new messages are shed for a backed up target, edits and deletes never are
+                        if not self.scheduler.submit(
+                            channel_id,
+                            functools.partial(self.handle_event, func, payload, channel_id, bridge_name),
+                            sheddable=new_message and self.flood is not None
+                        ):
+                            l.debug("Target %s is backed up, shedding message %s", channel_id, payload["message"].id)
+                            self.flood.shed()
+                            self.coalescer.finish(payload)
+                            self.outbox.ack(payload, channel_id)
+                l.debug("Finished dispatching payload!")
             except asyncio.CancelledError:
                 l.info(f"Stopped!")
                 break
-
-    def generate_message_bundle(self, message):
-        author = f"{message.author} (#{message.channel.name} in {message.guild.name})"
-
-        if not message.embeds and not message.attachments:
-            if '\n' in message.content:
-                return f"`{author}`:\n{message.content}", None
-            else:
-                return f"{message.content} `from {author}`", None
-
-        e = message.embeds[0] if message.embeds else Embed(color=message.author.color)
-        if message.author.avatar:
-            pfp = message.author.avatar.url
-        else:
-            pfp = message.author.default_avatar.url
-        e.set_author(name=author,
-                     icon_url=pfp)
-        #
-        e.description = message.content or "No Message Content"
-        # try to display images largely
-        if len(message.attachments) == 1 and message.attachments[0].content_type.startswith("image/"):
-            e.set_image(url=message.attachments[0].url)
-        elif len(message.attachments) > 1:
-            # otherwise, add attachments as fields
-            for i, attachment in enumerate(message.attachments):
-                e.add_field(name=f"Attachment #{i + 1}",
-                            value=f"[{attachment.description or attachment.filename}]({attachment.url})")
-        content = ""
-        return content, e
+            except Exception as e:
+                # one bad payload mustn't stop the bridge
+                report_error(e)
+                l.error(f"Failed to dispatch payload: {e}")
+                continue
+
+    async def resolve_reference(self, channel, message):
+        # references are built from stored ids only and don't fail if the message is gone,
+        # so no message has to be fetched to reply to it
+        if not message.reference:
+            return None
+        reference = None
+        # check if the message is a reply to a non-bridged message
+        db_message = await self.mappings.find(message.reference.message_id, channel.id)
+        if not db_message:
+            # let's check if this was a reply to a bridged message then
+            db_message = await self.mappings.find_by_bridged(message.reference.message_id)
+            if db_message:
+                # good, this is a reply to a bridged message, let's get the original message id
+                original_message_id = db_message["message_id"]
+                # check if there is a bridged message in the target channel with this id
+                db_message = await self.mappings.find(original_message_id, channel.id)
+                if not db_message:
+                    # the original was never bridged to the target channel, so it lives there
+                    reference = channel.get_partial_message(original_message_id)
+        if db_message:
+            # reply to bridged message
+            reference = channel.get_partial_message(db_message["bridged_message_id"])
+        if reference:
+            reference = reference.to_reference(fail_if_not_exists=False)
+        return reference
 
     async def handle_new_message(self, target_channel, message, bridge_name):
-        channel = self.bot.get_channel(target_channel)
+        channel = self.get_target(target_channel)
         if channel is None:
             log.warning(f"Bridge {bridge_name} target channel {target_channel} not found!")
             return
         # handle replies
-        reference = None
-        if message.reference:
-            # check if the message is a reply to a non-bridged message
-            db_message = await self.db.messages.find_one(
-                {
-                    "message_id"    : message.reference.message_id,
-                    "target_channel": target_channel
-                })
-            if db_message:
-                # reply to bridged message
-                reference = await channel.fetch_message(db_message["bridged_message_id"])
-            if not db_message:
-                # let's check if this was a reply to a bridged message then
-                db_message = await self.db.messages.find_one(
-                    {
-                        "bridged_message_id": message.reference.message_id
-                    })
-                if db_message:
-                    # good, this is a reply to a bridged message, let's get the original message id
-                    original_message_id = db_message["message_id"]
-                    # check if the original message is in the target channel
-                    try:
-                        original_message = await channel.fetch_message(original_message_id)
-                    except NotFound:
-                        pass
-                    else:
-                        # good, the original message is in the target channel, let's reply to it
-                        reference = original_message
-                    if not reference:
-                        # check if there is a bridged message in the target channel with this id
-                        db_message = await self.db.messages.find_one(
-                            {
-                                "message_id"    : original_message_id,
-                                "target_channel": target_channel
-                            })
-                        if db_message:
-                            # good, there is a bridged message in the target channel with this id
-                            reference = await channel.fetch_message(db_message["bridged_message_id"])
-        # handle embeds
-        content, e = self.generate_message_bundle(message)
-
-        bridged_message = await channel.send(
-            content=content,
-            reference=reference,
-            embed=e,
-            allowed_mentions=AllowedMentions(everyone=False, users=False, roles=False, replied_user=bool(message.mentions))
-        )
+        with metrics.span("reply"):
+            reference = await self.resolve_reference(channel, message)
+        allowed_mentions = AllowedMentions(everyone=False, users=False, roles=False, replied_user=bool(message.mentions))
+
+        with metrics.span("render"):
+            rendered = self.renders.get(message)
+
+        # attachments too large for the target guild, or that failed to download, are linked instead
+        uploads, links = [], []
+        if self.attachments and message.attachments:
+            uploads, links = await self.attachments.prepare(message, channel)
+
+        bridged_message = None
+        webhook = await self.webhooks.get(channel) if self.webhooks else None
+        if webhook:
+            files, missing = self.attachments.open(uploads) if uploads else ([], [])
+            try:
+                with metrics.span("send"):
+                    bridged_message = await webhook.send(
+                        content="\n".join(filter(None, [rendered.webhook_content(reference)] + links + missing)),
+                        embeds=list(rendered.webhook_embeds),
+                        username=rendered.username,
+                        avatar_url=rendered.avatar_url,
+                        allowed_mentions=allowed_mentions,
+                        wait=True,
+                        **({"files": files} if files else {})
+                    )
+            except (NotFound, Forbidden):
+                log.warning(f"Bridge {bridge_name} webhook for channel {target_channel} is unusable, sending as bot")
+                await self.webhooks.invalidate(target_channel)
+        if bridged_message is None:
+            files, missing = self.attachments.open(uploads) if uploads else ([], [])
+            with metrics.span("send"):
+                bridged_message = await channel.send(
+                    content="\n".join(filter(None, [rendered.content] + links + missing)),
+                    reference=reference,
+                    embed=rendered.embed,
+                    allowed_mentions=allowed_mentions,
+                    **({"files": files} if files else {})
+                )
         # add to message collection
-        await self.db.messages.insert_one({
-            "message_id"        : message.id,
-            "bridged_message_id": bridged_message.id,
-            "target_channel"    : target_channel
-        })
+        with metrics.span("persist"):
+            self.mappings.add(message.id, target_channel, bridged_message.id)
 
     async def handle_edited_message(self, target_channel, message, bridge_name):
-        channel = self.bot.get_channel(target_channel)
+        channel = self.get_target(target_channel)
         if channel is None:
             log.warning(f"Bridge {bridge_name} target channel {target_channel} not found!")
             return
         # get bridged message from collection
-        bridged_message = await self.db.messages.find_one({"message_id"    : message.id,
-                                                           "target_channel": target_channel})
+        bridged_message = await self.mappings.find(message.id, target_channel)
         if bridged_message is None:
             log.warning(f"Bridge {bridge_name} message {message.id} not found!")
             return
         # edit bridged message
-        content, e = self.generate_message_bundle(message)
-        bridged_message = await channel.fetch_message(bridged_message["bridged_message_id"])
-        await bridged_message.edit(content=content, embed=e)
+        with metrics.span("render"):
+            rendered = self.renders.get(message)
+        webhook = self.webhooks.cached(target_channel) if self.webhooks else None
+        if webhook:
+            with metrics.span("reply"):
+                reference = await self.resolve_reference(channel, message)
+            try:
+                with metrics.span("send"):
+                    await webhook.edit_message(
+                        bridged_message["bridged_message_id"],
+                        content=rendered.webhook_content(reference),
+                        embeds=list(rendered.webhook_embeds)
+                    )
+                return
+            except HTTPException:
+                # sent as bot before webhooks were available, edit it as bot
+                pass
+        with metrics.span("send"):
+            await channel.get_partial_message(bridged_message["bridged_message_id"]).edit(
+                content=rendered.content,
+                embed=rendered.embed
+            )
 
     async def handle_deleted_message(self, target_channel, message, bridge_name):
-        channel = self.bot.get_channel(target_channel)
+        channel = self.get_target(target_channel)
         if channel is None:
             log.warning(f"Bridge {bridge_name} target channel {target_channel} not found!")
             return
         # get bridged message from collection
-        bridged_message = await self.db.messages.find_one({"message_id"    : message.id,
-                                                           "target_channel": target_channel})
+        bridged_message = await self.mappings.find(message.id, target_channel)
         if bridged_message is None:
             log.warning(f"Bridge {bridge_name} message {message.id} not found!")
             return
         # delete bridged message
-        bridged_message = await channel.fetch_message(bridged_message["bridged_message_id"])
-        await bridged_message.delete()
+        webhook = self.webhooks.cached(target_channel) if self.webhooks else None
+        try:
+            with metrics.span("send"):
+                if webhook:
+                    try:
+                        await webhook.delete_message(bridged_message["bridged_message_id"])
+                    except NotFound:
+                        # sent as bot before webhooks were available, delete it as bot
+                        await channel.get_partial_message(bridged_message["bridged_message_id"]).delete()
+                else:
+                    await channel.get_partial_message(bridged_message["bridged_message_id"]).delete()
+        except NotFound:
+            log.warning(f"Bridge {bridge_name} bridged message {bridged_message['bridged_message_id']} already deleted!")
         # delete from collection
-        await self.db.messages.delete_one({"message_id"    : message.id,
-                                           "target_channel": target_channel})
+        with metrics.span("persist"):
+            self.mappings.remove(message.id, target_channel, bridged_message["bridged_message_id"])
+
+    async def handle_bulk_deleted_messages(self, target_channel, mappings, bridge_name):
+        channel = self.get_target(target_channel)
+        if channel is None:
+            log.warning(f"Bridge {bridge_name} target channel {target_channel} not found!")
+            return
+        # the mappings were fetched once for all targets, see bulk_mappings
+        bridged = {
+            message_id: targets[target_channel]
+            for message_id, targets in mappings.items()
+            if target_channel in targets
+        }
+        if not bridged:
+            return
+        partials = [channel.get_partial_message(bridged_message_id) for bridged_message_id in bridged.values()]
+        one_by_one = not hasattr(channel, "delete_messages")
+        if not one_by_one:
+            try:
+                # bulk deletes are limited to 100 messages per call
+                for i in range(0, len(partials), 100):
+                    await channel.delete_messages(partials[i:i + 100])
+            except HTTPException as err:
+                # missing manage messages or messages older than two weeks
+                log.warning(f"Bridge {bridge_name} bulk delete in {target_channel} failed ({err}), deleting one by one")
+                one_by_one = True
+        # partial channels of guilds on another shard can't bulk delete either
+        if one_by_one:
+            webhook = self.webhooks.cached(target_channel) if self.webhooks else None
+            for partial in partials:
+                try:
+                    if webhook:
+                        await webhook.delete_message(partial.id)
+                    else:
+                        await partial.delete()
+                except NotFound:
+                    pass
+        for message_id, bridged_message_id in bridged.items():
+            self.mappings.remove(message_id, target_channel, bridged_message_id)
+
+    async def handle_digest(self, target_channel, content, bridge_name):
+        channel = self.get_target(target_channel)
+        if channel is None:
+            log.warning(f"Bridge {bridge_name} target channel {target_channel} not found!")
+            return
+        # digests aren't mapped, edits and deletes of the merged messages aren't bridged
+        with metrics.span("send"):
+            await channel.send(content=content, allowed_mentions=AllowedMentions.none())
 
     @commands.Cog.listener()
     async def on_message(self, message):
+        # check if this channel is connected to a bridge
+        bridge_name = self.channel_bridges.get(message.channel.id)
+        if bridge_name is None:
+            return
         if message.author == self.bot.user:
             return
+        if message.webhook_id and self.webhooks and await self.webhooks.is_own(
+                message.webhook_id, getattr(message, "application_id", None)):
+            return
         if message.guild is None:
             return
-        # check if this channel is connected to a bridge
-        current_channel_id = message.channel.id
-        bridge = await self.db.bridges.find_one({"channels": current_channel_id})
-        if not bridge:
+        if self.flood and not self.flood.admit(bridge_name, message):
+            # merged into a digest, the backfill must not replay it one by one after a restart
+            self.outbox.advance(message.channel.id, message.id)
             return
-        await self.bridge_queues[bridge["name"]].put({"type": "new_message", "message": message})
-        log.debug(f"New message put in Queue for Bridge {bridge['name']}")
+        self.coalescer.new_message(bridge_name, {"type": "new_message", "message": message})
+        log.debug("New message put in Queue for Bridge %s", bridge_name)
+
+    # raw events fire for every message, not only for those still in discord.py's message cache,
+    # so the message cache can be kept small or disabled entirely
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before, after):
-        if before.author == self.bot.user:
+    async def on_raw_message_edit(self, payload):
+        # check if this channel is connected to a bridge
+        bridge_name = self.channel_bridges.get(payload.channel_id)
+        if bridge_name is None:
             return
-        if before.guild is None:
+        if payload.guild_id is None:
             return
-        # check if this channel is connected to a bridge
-        current_channel_id = before.channel.id
-        bridge = await self.db.bridges.find_one({"channels": current_channel_id})
-        if not bridge:
+        data = payload.data
+        if int(data.get("author", {}).get("id", 0)) == self.bot.user.id:
+            return
+        webhook_id = data.get("webhook_id")
+        if webhook_id and self.webhooks and await self.webhooks.is_own(int(webhook_id), data.get("application_id")):
+            return
+        message = getattr(payload, "message", None)
+        if message is None:
+            channel = self.bot.get_channel(payload.channel_id)
+            if channel is None or "content" not in data:
+                return
+            message = Message(state=self.bot._connection, channel=channel, data=data)
+        if payload.cached_message is not None and unchanged(payload.cached_message, message):
+            # nothing the bridged copies show changed
             return
-        await self.bridge_queues[bridge["name"]].put({"type": "edited_message", "message": after})
-        log.debug(f"Edited message put in Queue for Bridge {bridge['name']}")
+        self.coalescer.edited_message(bridge_name, {"type": "edited_message", "message": message})
+        log.debug("Edited message handed to coalescer for Bridge %s", bridge_name)
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message):
-        if message.author == self.bot.user:
+    async def on_raw_message_delete(self, payload):
+        # check if this channel is connected to a bridge
+        bridge_name = self.channel_bridges.get(payload.channel_id)
+        if bridge_name is None:
             return
-        if message.guild is None:
+        if payload.guild_id is None:
             return
+        if self.mappings.cache.is_bridged(payload.message_id):
+            # one of our own bridged copies got deleted
+            return
+        self.renders.forget(payload.message_id)
+        message = payload.cached_message
+        if message is None:
+            channel = self.bot.get_channel(payload.channel_id) or self.bot.get_partial_messageable(payload.channel_id)
+            message = channel.get_partial_message(payload.message_id)
+        elif message.author == self.bot.user:
+            return
+        self.coalescer.deleted_message(bridge_name, {"type": "deleted_message", "message": message})
+        log.debug("Deleted message handed to coalescer for Bridge %s", bridge_name)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
         # check if this channel is connected to a bridge
-        current_channel_id = message.channel.id
-        bridge = await self.db.bridges.find_one({"channels": current_channel_id})
-        if not bridge:
+        bridge_name = self.channel_bridges.get(payload.channel_id)
+        if bridge_name is None:
             return
-        await self.bridge_queues[bridge["name"]].put({"type": "deleted_message", "message": message})
-        log.debug(f"Deleted message put in Queue for Bridge {bridge['name']}")
+        if payload.guild_id is None:
+            return
+        message_ids = [
+            message_id for message_id in payload.message_ids
+            if not self.mappings.cache.is_bridged(message_id)
+        ]
+        if not message_ids:
+            return
+        self.coalescer.bulk_deleted_messages(bridge_name, {
+            "type"       : "bulk_deleted_messages",
+            "channel_id" : payload.channel_id,
+            "message_ids": message_ids
+        })
+        log.debug("Bulk delete of %s messages handed to coalescer for Bridge %s", len(message_ids), bridge_name)
 
     @commands.hybrid_command(default_permission=False)
     @commands.is_owner()
@@ -345,7 +910,7 @@ class Bridge(commands.Cog):
         # connect the channel to the bridge
         await self.db.bridges.update_one({"name": bridge_name},
                                          {"$push": {"channels": ctx.channel.id}})
-        await self.maintenance()
+        await self.refresh_bridge(bridge_name)
         await ctx.reply('Channel connected to bridge!', ephemeral=True)
 
     @delete.autocomplete("bridge_name")
@@ -375,10 +940,30 @@ class Bridge(commands.Cog):
 
         # disconnect the channel from the bridge
         await self.db.bridges.update_one({"name": bridge_name},
-                                         {"$pull": {"channels": ctx.channel.id}})
-        await self.maintenance()
+                                         {"$pull": {"channels": ctx.channel.id},
+                                          "$unset": {f"modes.{ctx.channel.id}": ""}})
+        await self.refresh_bridge(bridge_name)
         await ctx.respond('Channel disconnected from bridge!', ephemeral=True)
 
+    @commands.hybrid_command(default_permission=False)
+    @commands.is_owner()
+    async def mode(self,
+                   ctx: commands.Context,
+                   mode: Literal["both", "send", "receive"]):
+        """Set whether the current channel sends to its bridge, receives from it or both"""
+        await ctx.defer(ephemeral=True)
+        bridge = await self.db.bridges.find_one({"channels": ctx.channel.id})
+        if not bridge:
+            await ctx.reply("This channel is not bridged!", ephemeral=True)
+            return
+        if mode == "both":
+            update = {"$unset": {f"modes.{ctx.channel.id}": ""}}
+        else:
+            update = {"$set": {f"modes.{ctx.channel.id}": mode}}
+        await self.db.bridges.update_one({"name": bridge["name"]}, update)
+        await self.refresh_bridge(bridge["name"])
+        await ctx.reply(f"Channel mode set to {mode}!", ephemeral=True)
+
     @disconnect.autocomplete("bridge_name")
     async def match_connected_bridge_name(self, ctx, name: str):
         bridge = await self.db.bridges.find_one({'channels': ctx.channel.id})
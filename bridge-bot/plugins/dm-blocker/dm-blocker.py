@@ -1,7 +1,8 @@
+import asyncio
+import heapq
 import logging
 
-import motor.motor_asyncio
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.ext.commands import Context
 import datetime
 from discord import app_commands
@@ -13,33 +14,121 @@ from utils.reporter import report_error
 log = logging.getLogger(__name__)
 log.setLevel(cfg["log_level"])
 
+# discord pauses dms for at most 24 hours at a time
+PAUSE = datetime.timedelta(hours=24)
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
 
 class DMBlocker(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo = motor.motor_asyncio.AsyncIOMotorClient(cfg["mongodb_uri"])
-        self.db = self.mongo.dm_blocker
-        if not self.run_loop.is_running() and bot.is_ready():
-            self.run_loop.start()
+        self.db = bot.mongo.dm_blocker
+        # refresh this long before the pause runs out
+        self.margin = datetime.timedelta(minutes=cfg.get("dm_blocker.refresh_margin_minutes", 60))
+        # first retry delay after a failed refresh, doubled on every further failure up to a quarter of the margin
+        self.retry_delay = cfg.get("dm_blocker.retry_delay", 60)
+        self.semaphore = asyncio.Semaphore(cfg.get("dm_blocker.concurrency", 5))
+        # guild_id -> when its pause has to be refreshed
+        self.due = {}
+        # (due, guild_id), entries that don't match self.due anymore are stale
+        self.schedule = []
+        # guild_id -> consecutive failed refreshes
+        self.failures = {}
+        # guilds with dm protection enabled, on this process' shards
+        self.enabled = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        if bot.is_ready():
+            self.start()
 
     @commands.Cog.listener()
     async def on_ready(self):
-        if self.run_loop.is_running():
-            return
-        self.run_loop.start()
+        self.start()
+
+    def start(self):
+        if self.task is None:
+            self.task = self.bot.loop.create_task(self.run_loop())
+
+    async def cog_unload(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def is_local(self, guild_id):
+        # with several processes each refreshes the guilds on its own shards
+        shard_ids = getattr(self.bot, "shard_ids", None)
+        return not shard_ids or (guild_id >> 22) % self.bot.shard_count in shard_ids
 
+    def plan(self, guild_id, when):
+        self.enabled.add(guild_id)
+        self.due[guild_id] = when
+        heapq.heappush(self.schedule, (when, guild_id))
+        self.wakeup.set()
+
+    def forget(self, guild_id):
+        self.enabled.discard(guild_id)
+        self.due.pop(guild_id, None)
+        self.failures.pop(guild_id, None)
 
-    @tasks.loop(hours=23, minutes=55) # hourly
     async def run_loop(self):
-        # get all pinned messages in db
-        enabled_servers = await self.db.guilds.find().to_list(length=None)
+        while True:
+            try:
+                enabled_servers = await self.db.guilds.find().to_list(length=None)
+                break
+            except Exception as err:
+                report_error(err)
+                await asyncio.sleep(self.retry_delay)
+        now = utcnow()
         for server in enabled_servers:
+            if not self.is_local(server["id"]):
+                continue
+            guild = self.bot.get_guild(server["id"])
+            paused_until = getattr(guild, "dms_paused_until", None)
+            # spread the refreshes by when each pause actually runs out
+            self.plan(server["id"], max(now, paused_until - self.margin) if paused_until else now)
+        log.info(f"Scheduled dm protection refresh of {len(self.due)} guilds")
+        pending = set()
+        while True:
+            self.wakeup.clear()
+            now = utcnow()
+            while self.schedule and self.schedule[0][0] <= now:
+                when, guild_id = heapq.heappop(self.schedule)
+                if self.due.get(guild_id) != when:
+                    # rescheduled or disabled in the meantime
+                    continue
+                del self.due[guild_id]
+                task = self.bot.loop.create_task(self.refresh(guild_id))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            timeout = (self.schedule[0][0] - now).total_seconds() if self.schedule else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh(self, guild_id):
+        async with self.semaphore:
             try:
-                guild = await self.bot.fetch_guild(server["id"])
-                await guild.edit(
-                    dms_disabled_until=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=24))
+                # the cached guild saves a request, only guilds missing from the cache are fetched
+                guild = self.bot.get_guild(guild_id) or await self.bot.fetch_guild(guild_id)
+                paused_until = utcnow() + PAUSE
+                await guild.edit(dms_disabled_until=paused_until)
             except Exception as err:
-                await report_error(err)
+                failures = self.failures[guild_id] = self.failures.get(guild_id, 0) + 1
+                # capped so several retries still fit in the margin before the pause runs out
+                delay = min(self.retry_delay * 2 ** (failures - 1), max(self.retry_delay, self.margin.total_seconds() / 4))
+                log.warning(f"Failed to refresh dm protection of guild {guild_id}, retrying in {delay:.0f}s: {err}")
+                if guild_id in self.enabled and guild_id not in self.due:
+                    self.plan(guild_id, utcnow() + datetime.timedelta(seconds=delay))
+                if failures == 1:
+                    report_error(err)
+                return
+        self.failures.pop(guild_id, None)
+        # disabled while the refresh was running, or already rescheduled by enabling it again
+        if guild_id in self.enabled and guild_id not in self.due:
+            self.plan(guild_id, paused_until - self.margin)
 
 # only allow people with admin perms to enable/disable dm protection
     @commands.hybrid_command(default_permission=False)
@@ -53,10 +142,11 @@ class DMBlocker(commands.Cog):
             await ctx.guild.edit(
                 dms_disabled_until=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=24))
             await self.db.guilds.insert_one({"id": ctx.guild.id})
+            self.plan(ctx.guild.id, utcnow() + PAUSE - self.margin)
             await ctx.reply("Enabled dm protection", ephemeral=True)
         except Exception as err:
             await ctx.reply("I need the manage server permission to enable dm protection", ephemeral=True)
-            await report_error(err)
+            report_error(err)
 
 
     @commands.hybrid_command(default_permission=False)
@@ -66,10 +156,11 @@ class DMBlocker(commands.Cog):
         try:
             await ctx.guild.edit(dms_disabled_until=None)
             await self.db.guilds.delete_one({"id": ctx.guild.id})
+            self.forget(ctx.guild.id)
             await ctx.reply("Disabled dm protection", ephemeral=True)
         except Exception as err:
             await ctx.reply("I need the manage server permission to disable dm protection", ephemeral=True)
-            await report_error(err)
+            report_error(err)
 
 
 
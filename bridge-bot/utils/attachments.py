@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+import aiohttp
+from discord import File
+
+from utils.cfg import cfg
+
+log = logging.getLogger("attachments")
+log.setLevel(cfg["log_level"])
+
+# upload limit of guilds without boosts, used when the target guild isn't cached
+DEFAULT_LIMIT = 10 * 1024 * 1024
+
+
+class AttachmentStore:
+    """
+    Downloads attachments once and keeps them on disk under the hash of their content,
+    so every target of a bridge uploads the same local file instead of fetching it again.
+    Downloads are streamed to disk in chunks, never held in memory as a whole.
+    """
+
+    def __init__(self, directory, max_cache_size=1024 * 1024 * 1024, max_file_size=100 * 1024 * 1024,
+                 concurrency=4, chunk_size=64 * 1024, index_size=10000):
+        self.directory = directory
+        self.max_cache_size = max_cache_size
+        self.max_file_size = max_file_size
+        self.chunk_size = chunk_size
+        self.index_size = index_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # attachment id -> content hash, oldest first
+        self.index = OrderedDict()
+        # attachment id -> download task, shared by every target waiting for it
+        self.downloads = {}
+        self.session = None
+        # content hash -> (written at, size) of the files on disk, oldest first, so eviction
+        # doesn't have to scan the directory. None until the one initial scan finished
+        self.cached = None
+        self.total_size = 0
+        self.scan_task = None
+        self.downloaded = 0
+        self.reused = 0
+        os.makedirs(directory, exist_ok=True)
+
+    async def close(self):
+        for task in self.downloads.values():
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    async def fetch(self, attachment):
+        """Path of the attachment's content on disk, downloading it unless a copy is cached."""
+        digest = self.index.get(attachment.id)
+        if digest is not None and self.has(digest):
+            self.reused += 1
+            self.index.move_to_end(attachment.id)
+            self.touch(digest)
+            return self.path(digest)
+        task = self.downloads.get(attachment.id)
+        if task is None:
+            task = self.downloads[attachment.id] = asyncio.get_running_loop().create_task(self._download(attachment))
+            task.add_done_callback(lambda _: self.downloads.pop(attachment.id, None))
+        else:
+            self.reused += 1
+        # shielded, one target giving up must not cancel the download for the others
+        return await asyncio.shield(task)
+
+    async def _download(self, attachment):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            digest = hashlib.sha256()
+            size = 0
+            # disk access runs in the executor, a slow disk mustn't stall the gateway
+            fd, tmp = await loop.run_in_executor(None, functools.partial(tempfile.mkstemp, dir=self.directory, suffix=".part"))
+            f = os.fdopen(fd, "wb")
+            try:
+                async with self.session.get(attachment.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_file_size:
+                            raise ValueError(f"attachment {attachment.id} is larger than {self.max_file_size} bytes")
+                        digest.update(chunk)
+                        await loop.run_in_executor(None, f.write, chunk)
+                await loop.run_in_executor(None, f.close)
+                path = self.path(digest.hexdigest())
+                # identical content posted again just replaces the same file
+                await loop.run_in_executor(None, os.replace, tmp, path)
+            except BaseException:
+                # failed downloads are rare, cleaning up inline is fine
+                f.close()
+                os.unlink(tmp)
+                raise
+        self.downloaded += 1
+        self.index[attachment.id] = digest.hexdigest()
+        while len(self.index) > self.index_size:
+            self.index.popitem(last=False)
+        await self.track(digest.hexdigest(), size)
+        self.evict()
+        return path
+
+    def _scan(self):
+        # runs in an executor, only once per start
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return OrderedDict((name, (mtime, size)) for mtime, name, size in sorted(entries))
+
+    async def track(self, name, size):
+        if self.cached is None:
+            if self.scan_task is None:
+                self.scan_task = asyncio.get_running_loop().run_in_executor(None, self._scan)
+            files = await self.scan_task
+            if self.cached is None:
+                self.cached = files
+                self.total_size = sum(size for _, size in files.values())
+        # the same content written again replaces its file
+        old = self.cached.pop(name, None)
+        if old is not None:
+            self.total_size -= old[1]
+        self.cached[name] = (time.time(), size)
+        self.total_size += size
+
+    def has(self, digest):
+        if self.cached is None:
+            # before the initial scan finished
+            return os.path.exists(self.path(digest))
+        return digest in self.cached
+
+    def touch(self, digest):
+        # a reused file counts as just written, so evict() keeps it while the targets upload it
+        if self.cached is not None and digest in self.cached:
+            self.cached[digest] = (time.time(), self.cached[digest][1])
+            self.cached.move_to_end(digest)
+
+    def evict(self):
+        # drop the least recently used files until the cache fits again,
+        # recent ones may still be uploading to other targets
+        keep_after = time.time() - 300
+        while self.total_size > self.max_cache_size and self.cached:
+            name, (written_at, size) = next(iter(self.cached.items()))
+            if written_at > keep_after:
+                break
+            del self.cached[name]
+            self.total_size -= size
+            # unlinked inline, in an executor it could race a download writing the same content again
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    async def prepare(self, message, channel):
+        """
+        Split a message's attachments into files to upload to the target channel and URLs to link
+        instead, for attachments above the target guild's upload limit or failed downloads.
+        Returns ([(path, attachment)], [url]).
+        """
+        guild = getattr(channel, "guild", None)
+        limit = min(getattr(guild, "filesize_limit", None) or DEFAULT_LIMIT, self.max_file_size)
+        uploads, candidates, links = [], [], []
+        total = 0
+        for attachment in message.attachments:
+            # the upload limit applies to the whole request, not to each file
+            if total + attachment.size > limit:
+                links.append(attachment.url)
+                continue
+            total += attachment.size
+            candidates.append(attachment)
+        paths = await asyncio.gather(*(self.fetch(attachment) for attachment in candidates), return_exceptions=True)
+        for attachment, path in zip(candidates, paths):
+            if isinstance(path, BaseException):
+                log.warning(f"Failed to download attachment {attachment.id}: {path}")
+                links.append(attachment.url)
+            else:
+                uploads.append((path, attachment))
+        return uploads, links
+
+    @staticmethod
+    def open(uploads):
+        """
+        Fresh File objects for every send attempt, discord.py closes them after each one.
+        Returns (files, urls), files evicted since prepare() are linked by url instead.
+        """
+        files, urls = [], []
+        for path, attachment in uploads:
+            try:
+                files.append(File(path, filename=attachment.filename, description=attachment.description))
+            except FileNotFoundError:
+                urls.append(attachment.url)
+        return files, urls
+
+    def stats(self):
+        return {"downloaded": self.downloaded, "reused": self.reused, "in_flight": len(self.downloads)}
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+from utils.cfg import cfg
+
+log = logging.getLogger("coalesce")
+log.setLevel(cfg["log_level"])
+
+
+class EventCoalescer:
+    """
+    Sits between the gateway listeners and the bridge queues and drops work that
+    would be overwritten anyway before it reaches the Discord API:
+
+    - edits are held back for a short window, further edits of the same message
+      only replace the held version
+    - edits of a message whose send hasn't started yet just update what will be sent
+    - a delete of a message whose send hasn't started yet cancels the send and is dropped
+    """
+
+    def __init__(self, enqueue, window=1.0):
+        # callable(bridge_name, payload) putting a payload on a bridge queue
+        self.enqueue = enqueue
+        self.window = window
+        # message_id -> new_message payload that is not delivered to every target yet
+        self.sends = {}
+        # message_id -> (bridge_name, edited_message payload) held back for the window
+        self.edits = {}
+        # number of events that never had to be delivered
+        self.coalesced = 0
+
+    def new_message(self, bridge_name, payload):
+        payload.update(started=0, remaining=0, cancelled=False)
+        self.sends[payload["message"].id] = payload
+        self.enqueue(bridge_name, payload)
+
+    def edited_message(self, bridge_name, payload):
+        message = payload["message"]
+        send = self.sends.get(message.id)
+        if send is not None and not send["cancelled"]:
+            # targets that haven't started yet will send the latest version
+            send["message"] = message
+            if not send["started"]:
+                self.coalesced += 1
+                return
+        held = self.edits.get(message.id)
+        if held is not None:
+            held[1]["message"] = message
+            self.coalesced += 1
+            return
+        self.edits[message.id] = (bridge_name, payload)
+        asyncio.get_running_loop().call_later(self.window, self._release_edit, message.id)
+
+    def deleted_message(self, bridge_name, payload):
+        message_id = payload["message"].id
+        if self.edits.pop(message_id, None) is not None:
+            self.coalesced += 1
+        send = self.sends.get(message_id)
+        if send is not None:
+            send["cancelled"] = True
+            if not send["started"]:
+                # nothing went out yet, so there is nothing to delete either
+                del self.sends[message_id]
+                self.coalesced += 1
+                log.debug("Send of message %s cancelled by delete", message_id)
+                return
+        self.enqueue(bridge_name, payload)
+
+    def bulk_deleted_messages(self, bridge_name, payload):
+        message_ids = []
+        for message_id in payload["message_ids"]:
+            if self.edits.pop(message_id, None) is not None:
+                self.coalesced += 1
+            send = self.sends.get(message_id)
+            if send is not None:
+                send["cancelled"] = True
+                if not send["started"]:
+                    del self.sends[message_id]
+                    self.coalesced += 1
+                    continue
+            message_ids.append(message_id)
+        if message_ids:
+            payload["message_ids"] = message_ids
+            self.enqueue(bridge_name, payload)
+
+    def _release_edit(self, message_id):
+        held = self.edits.pop(message_id, None)
+        if held is not None:
+            self.enqueue(*held)
+
+    def dispatch(self, payload, targets):
+        """Called once the bridge loop handed a new_message payload to its targets."""
+        payload["remaining"] = targets
+        if not targets:
+            self._forget(payload)
+
+    def abandon(self, payload):
+        """Called for a new_message payload that is not going to be dispatched at all."""
+        self._forget(payload)
+
+    def begin(self, payload):
+        """Called before a target sends, returns False if the send got cancelled."""
+        if payload["cancelled"]:
+            self.finish(payload)
+            return False
+        payload["started"] += 1
+        return True
+
+    def finish(self, payload):
+        payload["remaining"] -= 1
+        if payload["remaining"] <= 0:
+            self._forget(payload)
+
+    def _forget(self, payload):
+        message_id = payload["message"].id
+        if self.sends.get(message_id) is payload:
+            del self.sends[message_id]
@@ -0,0 +1,40 @@
+import hashlib
+import json
+import logging
+
+from discord import Object
+
+from utils.cfg import cfg
+
+log = logging.getLogger("commands")
+log.setLevel(cfg["log_level"])
+
+
+def commands_hash(tree, guild=None):
+    # hash the payload discord receives on a sync, so only changes discord would see count
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command["name"], command.get("type", 1))
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+
+async def sync_commands(tree, state, guild_ids=()):
+    """
+    Sync the command tree if its definitions changed since the last sync. With guild_ids the
+    global commands are copied to and synced with just those guilds, which takes effect at once.
+    """
+    for guild in [Object(id=guild_id) for guild_id in guild_ids] or [None]:
+        if guild is not None:
+            tree.copy_global_to(guild=guild)
+        scope = "globally" if guild is None else f"in guild {guild.id}"
+        key = "commands_hash" if guild is None else f"commands_hash:{guild.id}"
+        digest = commands_hash(tree, guild)
+        db_entry = await state.find_one({"_id": key})
+        if db_entry and db_entry.get("hash") == digest:
+            log.info(f"Commands have not changed {scope}!")
+            continue
+        log.info(f"Commands have changed {scope}! Updating Commands...")
+        await tree.sync(guild=guild)
+        await state.update_one({"_id": key}, {"$set": {"hash": digest}}, upsert=True)
+        log.info(f"Commands updated {scope}!")
@@ -0,0 +1,20 @@
+import motor.motor_asyncio
+
+from utils.cfg import cfg
+from utils.metrics import metrics
+
+
+def create_client():
+    """
+    The MongoDB client shared by every plugin as bot.mongo. It connects lazily on the first
+    operation and pools its connections, so plugins take their database from it instead of
+    opening their own client.
+    """
+    return motor.motor_asyncio.AsyncIOMotorClient(
+        cfg["mongodb_uri"],
+        maxPoolSize=cfg.get("mongodb_pool.max_size", 50),
+        minPoolSize=cfg.get("mongodb_pool.min_size", 0),
+        appname="bridge-bot",
+        # commands are only timed once metrics are enabled
+        event_listeners=[metrics.mongo_listener]
+    )
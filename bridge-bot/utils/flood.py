@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import logging
+import time
+
+from utils.cfg import cfg
+from utils.scheduler import TokenBucket
+
+log = logging.getLogger("flood")
+log.setLevel(cfg["log_level"])
+
+DECISIONS = ("admitted", "digested", "digested_author", "overflow", "shed", "digests")
+
+
+class _Flooded:
+    """The next digest of a source channel, and whether all of its messages go into digests."""
+
+    __slots__ = ("bridge_name", "title", "entries", "omitted", "degraded", "arrivals", "since")
+
+    def __init__(self, bridge_name, title):
+        self.bridge_name = bridge_name
+        self.title = title
+        self.entries = []
+        self.omitted = 0
+        # False while only messages of authors over their bucket are collected
+        self.degraded = False
+        # messages seen since the last digest, decides when the channel calmed down
+        self.arrivals = 0
+        self.since = time.monotonic()
+
+
+class FloodGuard:
+    """
+    Admission control in front of the bridge queues. Every source channel and every author
+    has a token bucket. Messages of authors over their bucket are merged into the channel's
+    next digest, sent to every target once per digest_interval. A channel over its bucket, or
+    whose targets are backed up beyond max_backlog, is degraded: all its messages go into the
+    digests. The channel goes back to normal delivery once a whole interval passed with calm
+    traffic and short queues.
+    """
+
+    def __init__(self, emit, backlog=None, channel_rate=3, channel_burst=15, author_rate=1, author_burst=8,
+                 max_backlog=50, digest_interval=10, digest_size=20):
+        # callable(bridge_name, channel_id, content) putting a digest on the bridge queue
+        self.emit = emit
+        # optional callable(bridge_name, channel_id) -> longest target queue of the channel
+        self.backlog = backlog
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.author_rate = author_rate
+        self.author_burst = author_burst
+        self.max_backlog = max_backlog
+        self.digest_interval = digest_interval
+        self.digest_size = digest_size
+        # channel_id -> TokenBucket, author_id -> TokenBucket, dropped once refilled
+        self.channel_buckets = {}
+        self.author_buckets = {}
+        # author ids over their bucket, to log only when it starts
+        self.throttled = set()
+        # channel_id -> _Flooded
+        self.flooded = {}
+        self.decisions = collections.Counter()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        # digests aren't kept in the outbox, collected messages are lost like queued digests
+        self.flooded.clear()
+
+    def _take(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket.reserve() == 0
+
+    def admit(self, bridge_name, message):
+        """Return True if the message should be bridged on its own, otherwise it went into a digest."""
+        channel_id = message.channel.id
+        flooded = self.flooded.get(channel_id)
+        degraded = flooded is not None and flooded.degraded
+        if degraded:
+            flooded.arrivals += 1
+        author_id = message.author.id
+        if not self._take(self.author_buckets, author_id, self.author_rate, self.author_burst):
+            if author_id not in self.throttled:
+                self.throttled.add(author_id)
+                log.warning(f"Author {author_id} is flooding channel {channel_id} of Bridge {bridge_name}, merging their messages into digests")
+            self.add(flooded or self.collect(bridge_name, message), message)
+            self.decisions["digested_author"] += 1
+            return False
+        if not degraded:
+            if not self._take(self.channel_buckets, channel_id, self.channel_rate, self.channel_burst):
+                reason = "message rate"
+            elif self.backlog and self.backlog(bridge_name, channel_id) >= self.max_backlog:
+                reason = "target backlog"
+            else:
+                self.decisions["admitted"] += 1
+                return True
+            flooded = self.degrade(bridge_name, message, reason)
+        self.add(flooded, message)
+        self.decisions["digested"] += 1
+        return False
+
+    def overflow(self, bridge_name, message):
+        """Take a message the full bridge queue had no room for into the channel's digest."""
+        flooded = self.flooded.get(message.channel.id)
+        if flooded is None or not flooded.degraded:
+            flooded = self.degrade(bridge_name, message, "full bridge queue")
+        self.add(flooded, message)
+        self.decisions["overflow"] += 1
+
+    def shed(self):
+        # a target's queue was full, counted here so every decision shows up in one place
+        self.decisions["shed"] += 1
+
+    def collect(self, bridge_name, message):
+        title = f"#{message.channel.name} in {message.guild.name}"
+        flooded = self.flooded[message.channel.id] = _Flooded(bridge_name, title)
+        return flooded
+
+    def degrade(self, bridge_name, message, reason):
+        log.warning(f"Channel {message.channel.id} of Bridge {bridge_name} is flooded ({reason}), merging its messages into digests")
+        flooded = self.flooded.get(message.channel.id) or self.collect(bridge_name, message)
+        flooded.degraded = True
+        flooded.since = time.monotonic()
+        flooded.arrivals = 1
+        return flooded
+
+    def add(self, flooded, message):
+        if len(flooded.entries) >= self.digest_size:
+            flooded.omitted += 1
+            return
+        text = " ".join(message.content.split())
+        if len(text) > 200:
+            text = text[:199] + "…"
+        if message.attachments:
+            text += f" [{len(message.attachments)} attachment{'s' if len(message.attachments) > 1 else ''}]"
+        flooded.entries.append(f"**{message.author.display_name}**: {text}")
+
+    def flush(self, channel_id):
+        flooded = self.flooded[channel_id]
+        if not flooded.entries and not flooded.omitted:
+            return
+        count = len(flooded.entries) + flooded.omitted
+        lines = [f"**{count} message{'s' if count > 1 else ''} from {flooded.title}, merged because of flooding**"]
+        lines += flooded.entries
+        if flooded.omitted:
+            lines.append(f"*and {flooded.omitted} more*")
+        content = "\n".join(lines)
+        if len(content) > 2000:
+            content = content[:1999] + "…"
+        flooded.entries, flooded.omitted = [], 0
+        self.decisions["digests"] += 1
+        self.emit(flooded.bridge_name, channel_id, content)
+
+    def tick(self):
+        now = time.monotonic()
+        for channel_id, flooded in list(self.flooded.items()):
+            self.flush(channel_id)
+            if not flooded.degraded:
+                # only held messages of authors over their bucket, which just went out
+                del self.flooded[channel_id]
+                continue
+            calm = flooded.arrivals <= self.channel_rate * self.digest_interval / 2
+            if calm and self.backlog:
+                calm = self.backlog(flooded.bridge_name, channel_id) < self.max_backlog / 2
+            flooded.arrivals = 0
+            if calm:
+                del self.flooded[channel_id]
+                log.info(f"Channel {channel_id} of Bridge {flooded.bridge_name} recovered after {now - flooded.since:.0f}s")
+        # a bucket that had time to refill completely is no different from a new one
+        for channel_id, bucket in list(self.channel_buckets.items()):
+            if now - bucket.updated > self.channel_burst / self.channel_rate:
+                del self.channel_buckets[channel_id]
+        for author_id, bucket in list(self.author_buckets.items()):
+            if now - bucket.updated > self.author_burst / self.author_rate:
+                del self.author_buckets[author_id]
+                self.throttled.discard(author_id)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            try:
+                self.tick()
+            except Exception as err:
+                log.error(f"Failed to send flood digests: {err}")
+
+    def stats(self):
+        flooded = sum(flooded.degraded for flooded in self.flooded.values())
+        return dict(self.decisions, flooded=flooded, throttled=len(self.throttled))
@@ -0,0 +1,414 @@
+import asyncio
+import datetime
+import logging
+from collections import OrderedDict
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from utils.cfg import cfg
+
+log = logging.getLogger("mapping")
+log.setLevel(cfg["log_level"])
+
+
+class MappingCache:
+    """Bounded LRU of (message_id, target_channel) <-> bridged_message_id, indexed both ways."""
+
+    def __init__(self, size):
+        self.size = size
+        # (message_id, target_channel) -> bridged_message_id, oldest first
+        self.forward = OrderedDict()
+        # bridged_message_id -> (message_id, target_channel)
+        self.reverse = {}
+        # message_ids whose every mapping is cached, a missing target means it was never bridged there
+        self.complete = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.forward)
+
+    def get(self, key):
+        bridged_message_id = self.forward.get(key)
+        if bridged_message_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.forward.move_to_end(key)
+        return bridged_message_id
+
+    def get_source(self, bridged_message_id):
+        key = self.reverse.get(bridged_message_id)
+        if key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.forward.move_to_end(key)
+        return key
+
+    def peek(self, key):
+        # lookup without touching the counters or the order
+        return self.forward.get(key)
+
+    def is_bridged(self, message_id):
+        # lookup without touching the counters, used to skip pointless source lookups
+        return message_id in self.reverse
+
+    def is_complete(self, message_id):
+        return message_id in self.complete
+
+    def set_complete(self, message_id):
+        self.complete[message_id] = None
+        self.complete.move_to_end(message_id)
+        while len(self.complete) > self.size:
+            self.complete.popitem(last=False)
+
+    def put(self, key, bridged_message_id):
+        old = self.forward.pop(key, None)
+        if old is not None:
+            self.reverse.pop(old, None)
+        self.forward[key] = bridged_message_id
+        self.reverse[bridged_message_id] = key
+        while len(self.forward) > self.size:
+            (message_id, _), evicted = self.forward.popitem(last=False)
+            self.reverse.pop(evicted, None)
+            self.complete.pop(message_id, None)
+
+    def discard(self, key):
+        bridged_message_id = self.forward.pop(key, None)
+        if bridged_message_id is not None:
+            self.reverse.pop(bridged_message_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size"    : len(self.forward),
+            "hits"    : self.hits,
+            "misses"  : self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+class MessageMappings:
+    """
+    Write-behind store for the source message -> bridged message mapping.
+
+    Inserts and deletes are buffered and written with one insert_many / bulk_write
+    per flush. Unflushed writes are served from memory so lookups see them right away.
+
+    Two document layouts are supported. The default one stores a document per
+    (message, target) pair, the compact one stores a single document per source message:
+    {"message_id": ..., "targets": {"<target_channel>": bridged_message_id}, "bridged_ids": [...]}
+    Lookups return documents in the default layout either way.
+
+    Recently used mappings are kept in a bounded LRU so edits, deletes and replies
+    to recent messages are answered without a read.
+    """
+
+    def __init__(self, collection, flush_size=100, flush_interval=2, compact=False, ttl=None, cache_size=10000):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compact = compact
+        # seconds after which mappings expire, None keeps them forever
+        self.ttl = ttl
+        # (message_id, target_channel) -> document, not yet written
+        self.pending_inserts = {}
+        # bridged_message_id -> document, reverse view of pending_inserts
+        self.pending_bridged = {}
+        # (message_id, target_channel) tombstones, not yet deleted
+        self.pending_deletes = set()
+        # (message_id, target_channel) -> bridged_message_id of tombstones, for the compact layout's bridged_ids
+        self.deleted_ids = {}
+        # keys of inserts that are currently being written
+        self.in_flight = set()
+        # message_id -> running lookup, shared by the per-target handlers of one payload
+        self.lookups = {}
+        self.cache = MappingCache(cache_size)
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.flush_task = None
+
+    async def ensure_indexes(self):
+        if self.compact:
+            await self.collection.create_index([("message_id", ASCENDING)], unique=True)
+            await self.collection.create_index([("bridged_ids", ASCENDING)])
+        else:
+            await self.collection.create_index([("message_id", ASCENDING), ("target_channel", ASCENDING)])
+            await self.collection.create_index([("bridged_message_id", ASCENDING)])
+        if self.ttl:
+            try:
+                await self.collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=self.ttl)
+            except OperationFailure:
+                # the index exists with another expiry, update it in place
+                await self.collection.database.command(
+                    "collMod", self.collection.name,
+                    index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": self.ttl}
+                )
+            # mappings written before expiry was enabled have no created_at and would be kept forever,
+            # they expire ttl seconds from now instead
+            result = await self.collection.update_many(
+                {"created_at": {"$exists": False}},
+                {"$set": {"created_at": datetime.datetime.now(datetime.timezone.utc)}}
+            )
+            if result.modified_count:
+                log.info(f"Set created_at on {result.modified_count} older mappings of {self.collection.name}")
+        log.info(f"Indexes for {self.collection.name} ensured")
+
+    def start(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_loop())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as err:
+                log.error(f"Failed to flush message mappings: {err}")
+
+    def pending(self):
+        return len(self.pending_inserts) + len(self.pending_deletes)
+
+    def _maybe_wakeup(self):
+        if self.pending() >= self.flush_size:
+            self.wakeup.set()
+
+    def add(self, message_id, target_channel, bridged_message_id):
+        key = (message_id, target_channel)
+        doc = {
+            "message_id"        : message_id,
+            "bridged_message_id": bridged_message_id,
+            "target_channel"    : target_channel
+        }
+        self.pending_deletes.discard(key)
+        self.deleted_ids.pop(key, None)
+        self.pending_inserts[key] = doc
+        self.pending_bridged[bridged_message_id] = doc
+        self.cache.put(key, bridged_message_id)
+        self._maybe_wakeup()
+
+    def remove(self, message_id, target_channel, bridged_message_id=None):
+        key = (message_id, target_channel)
+        if bridged_message_id is None:
+            bridged_message_id = self.cache.peek(key)
+        self.cache.discard(key)
+        doc = self.pending_inserts.pop(key, None)
+        if doc is not None:
+            bridged_message_id = doc["bridged_message_id"]
+            self.pending_bridged.pop(bridged_message_id, None)
+            if key not in self.in_flight:
+                # never reached the db, nothing to delete
+                return
+        self.pending_deletes.add(key)
+        if bridged_message_id is not None:
+            self.deleted_ids[key] = bridged_message_id
+        self._maybe_wakeup()
+
+    async def find(self, message_id, target_channel):
+        key = (message_id, target_channel)
+        if key in self.pending_deletes:
+            return None
+        doc = self.pending_inserts.get(key)
+        if doc is not None:
+            return doc
+        bridged_message_id = self.cache.get(key)
+        if bridged_message_id is None and not self.cache.is_complete(message_id):
+            bridged_message_id = (await self.find_all(message_id)).get(target_channel)
+        if bridged_message_id is None:
+            return None
+        return {
+            "message_id"        : message_id,
+            "bridged_message_id": bridged_message_id,
+            "target_channel"    : target_channel
+        }
+
+    async def find_all(self, message_id):
+        """Return {target_channel: bridged_message_id} for every target of a message with one read."""
+        if self.cache.is_bridged(message_id):
+            # this is a bridged copy, it can't be the source of any mapping
+            return {}
+        lookup = self.lookups.get(message_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._load(message_id))
+            self.lookups[message_id] = lookup
+            lookup.add_done_callback(lambda _: self.lookups.pop(message_id, None))
+        return self._overlay(message_id, dict(await asyncio.shield(lookup)))
+
+    def cached_targets(self, message_id, targets):
+        """
+        Return {target_channel: bridged_message_id} for the given targets of a message if memory
+        can tell for every target, otherwise None. Never reads, so the fan-out can call it.
+        """
+        if self.cache.is_bridged(message_id):
+            return {}
+        complete = self.cache.is_complete(message_id)
+        found = {}
+        for target_channel in targets:
+            key = (message_id, target_channel)
+            if key in self.pending_deletes:
+                continue
+            doc = self.pending_inserts.get(key)
+            bridged_message_id = doc["bridged_message_id"] if doc is not None else self.cache.peek(key)
+            if bridged_message_id is not None:
+                found[target_channel] = bridged_message_id
+            elif not complete:
+                return None
+        return found
+
+    async def find_many(self, message_ids):
+        """Return {message_id: {target_channel: bridged_message_id}} for many messages with one read."""
+        message_ids = [message_id for message_id in message_ids if not self.cache.is_bridged(message_id)]
+        loaded = await self._load_many(message_ids) if message_ids else {}
+        return {message_id: self._overlay(message_id, loaded.get(message_id, {})) for message_id in message_ids}
+
+    def _overlay(self, message_id, targets):
+        # apply writes that haven't reached the db yet
+        for (pending_message_id, target_channel), doc in self.pending_inserts.items():
+            if pending_message_id == message_id:
+                targets[target_channel] = doc["bridged_message_id"]
+        for pending_message_id, target_channel in self.pending_deletes:
+            if pending_message_id == message_id:
+                targets.pop(target_channel, None)
+        return targets
+
+    async def _load(self, message_id):
+        return (await self._load_many([message_id])).get(message_id, {})
+
+    async def _load_many(self, message_ids):
+        loaded = {}
+        query = {"message_id": message_ids[0]} if len(message_ids) == 1 else {"message_id": {"$in": message_ids}}
+        if self.compact:
+            async for doc in self.collection.find(query, {"message_id": 1, "targets": 1}):
+                loaded[doc["message_id"]] = {
+                    int(target_channel): bridged for target_channel, bridged in doc.get("targets", {}).items()
+                }
+        else:
+            async for doc in self.collection.find(query, {"message_id": 1, "target_channel": 1, "bridged_message_id": 1}):
+                loaded.setdefault(doc["message_id"], {})[doc["target_channel"]] = doc["bridged_message_id"]
+        for message_id, targets in loaded.items():
+            for target_channel, bridged_message_id in targets.items():
+                if (message_id, target_channel) not in self.pending_deletes:
+                    self.cache.put((message_id, target_channel), bridged_message_id)
+        for message_id in message_ids:
+            # unwritten mappings are in pending_inserts, which every lookup checks first
+            self.cache.set_complete(message_id)
+        return loaded
+
+    async def find_by_bridged(self, bridged_message_id):
+        doc = self.pending_bridged.get(bridged_message_id)
+        if doc is not None:
+            return doc
+        key = self.cache.get_source(bridged_message_id)
+        if key is not None:
+            return {
+                "message_id"        : key[0],
+                "bridged_message_id": bridged_message_id,
+                "target_channel"    : key[1]
+            }
+        if self.compact:
+            compact_doc = await self.collection.find_one({"bridged_ids": bridged_message_id})
+            doc = None
+            if compact_doc:
+                for target_channel, bridged in compact_doc.get("targets", {}).items():
+                    if bridged == bridged_message_id:
+                        doc = {
+                            "message_id"        : compact_doc["message_id"],
+                            "bridged_message_id": bridged_message_id,
+                            "target_channel"    : int(target_channel)
+                        }
+                        break
+        else:
+            doc = await self.collection.find_one({"bridged_message_id": bridged_message_id})
+        if doc is None:
+            return None
+        key = (doc["message_id"], doc["target_channel"])
+        if key in self.pending_deletes:
+            return None
+        self.cache.put(key, bridged_message_id)
+        return doc
+
+    async def flush(self):
+        async with self.lock:
+            inserts = dict(self.pending_inserts)
+            deletes = set(self.pending_deletes)
+            deleted_ids = {key: self.deleted_ids[key] for key in deletes if key in self.deleted_ids}
+            if inserts:
+                self.in_flight = set(inserts)
+                try:
+                    if self.compact:
+                        await self._write_compact(inserts.values(), deletes, deleted_ids)
+                    else:
+                        await self._write_inserts(inserts.values())
+                finally:
+                    self.in_flight = set()
+                for key, doc in inserts.items():
+                    if self.pending_inserts.get(key) is doc:
+                        del self.pending_inserts[key]
+                        self.pending_bridged.pop(doc["bridged_message_id"], None)
+            if deletes:
+                if not self.compact:
+                    await self.collection.bulk_write([
+                        DeleteOne({"message_id": message_id, "target_channel": target_channel})
+                        for message_id, target_channel in deletes
+                    ], ordered=False)
+                elif not inserts:
+                    await self._write_compact((), deletes, deleted_ids)
+                self.pending_deletes -= deletes
+                for key in deletes:
+                    if key not in self.pending_deletes:
+                        self.deleted_ids.pop(key, None)
+            if inserts or deletes:
+                log.debug("Flushed %s inserts and %s deletes, cache: %s", len(inserts), len(deletes), self.cache.stats())
+
+    async def _write_inserts(self, docs):
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            await self.collection.insert_many([dict(doc, created_at=created_at) for doc in docs], ordered=False)
+        except BulkWriteError as err:
+            # partial failures are not retried, a retry would duplicate the written documents
+            log.error(f"Failed to insert some message mappings: {err.details.get('writeErrors')}")
+
+    async def _write_compact(self, docs, deletes, deleted_ids=None):
+        # group everything by source message so each message costs a single update
+        deleted_ids = deleted_ids or {}
+        updates = {}
+        pulls = {}
+        for doc in docs:
+            update = updates.setdefault(doc["message_id"], {})
+            update.setdefault("$set", {})[f"targets.{doc['target_channel']}"] = doc["bridged_message_id"]
+            update.setdefault("$addToSet", {"bridged_ids": {"$each": []}})["bridged_ids"]["$each"].append(
+                doc["bridged_message_id"])
+        for message_id, target_channel in deletes:
+            updates.setdefault(message_id, {}).setdefault("$unset", {})[f"targets.{target_channel}"] = ""
+            # so find_by_bridged stops matching the deleted copy
+            if (message_id, target_channel) in deleted_ids:
+                pulls.setdefault(message_id, []).append(deleted_ids[(message_id, target_channel)])
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        requests = []
+        for message_id, update in updates.items():
+            upsert = "$set" in update
+            if upsert:
+                update["$setOnInsert"] = {"created_at": created_at}
+            pull = {"bridged_ids": {"$in": pulls[message_id]}} if message_id in pulls else None
+            if pull and not upsert:
+                update["$pull"] = pull
+                pull = None
+            requests.append(UpdateOne({"message_id": message_id}, update, upsert=upsert))
+            if pull:
+                # one update can't add to and pull from bridged_ids at once, the two commute as the
+                # ids are never the same, and a copy to delete means the document exists already
+                requests.append(UpdateOne({"message_id": message_id}, {"$pull": pull}))
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
@@ -0,0 +1,209 @@
+import logging
+import re
+import time
+
+from pymongo import monitoring
+
+from utils.cfg import cfg
+from utils.flood import DECISIONS
+
+# prometheus_client is optional, without it metrics stay disabled
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+log = logging.getLogger("metrics")
+log.setLevel(cfg["log_level"])
+
+STAGES = ("route", "render", "reply", "send", "persist")
+
+
+def normalize_route(path):
+    # keep label cardinality low, every id becomes a placeholder
+    path = re.sub(r"^https?://[^/]+/api/v\d+", "", str(path))
+    path = re.sub(r"\{[a-z_]+\}", "{id}", path)
+    return re.sub(r"\d+", "{id}", path.split("?")[0])
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class MongoListener(monitoring.CommandListener):
+    """Times every command sent to MongoDB, per collection and command."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        # request_id -> (collection, command) of commands in flight
+        self.started_commands = {}
+
+    def started(self, event):
+        if self.metrics.enabled:
+            collection = event.command.get(event.command_name)
+            if not isinstance(collection, str):
+                collection = ""
+            self.started_commands[(event.connection_id, event.request_id)] = (collection, event.command_name)
+
+    def succeeded(self, event):
+        labels = self.started_commands.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            self.metrics.mongo_seconds.labels(*labels).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = self.started_commands.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            self.metrics.mongo_seconds.labels(*labels).observe(event.duration_micros / 1e6)
+            self.metrics.mongo_failures.labels(*labels).inc()
+
+
+class BridgeCollector:
+    """Reads the Bridge cog's queues and caches when prometheus scrapes, so the hot path doesn't pay for it."""
+
+    def __init__(self, cog):
+        self.cog = cog
+
+    def collect(self):
+        cog = self.cog
+        queues = GaugeMetricFamily("bridge_queue_length", "Payloads waiting in a bridge queue", labels=["bridge"])
+        for bridge_name, queue in list(cog.bridge_queues.items()):
+            queues.add_metric([bridge_name], queue.qsize())
+        yield queues
+        yield GaugeMetricFamily("bridge_target_queue_length", "Deliveries waiting in the per-target queues",
+                                value=cog.scheduler.depth())
+        yield GaugeMetricFamily("bridge_outbox_pending", "Payloads not yet delivered to every target",
+                                value=cog.outbox.pending())
+        yield CounterMetricFamily("bridge_coalesced_events", "Events that never had to be delivered",
+                                  value=cog.coalescer.coalesced)
+        if cog.flood:
+            stats = cog.flood.stats()
+            decisions = CounterMetricFamily("bridge_flood_decisions", "Admission decisions of the flood protection",
+                                            labels=["decision"])
+            for decision in DECISIONS:
+                decisions.add_metric([decision], stats.get(decision, 0))
+            yield decisions
+            yield GaugeMetricFamily("bridge_flood_degraded_channels", "Source channels currently merged into digests",
+                                    value=stats["flooded"])
+            yield GaugeMetricFamily("bridge_flood_throttled_authors", "Authors whose messages are merged into digests",
+                                    value=stats["throttled"])
+        for name, cache in (("mapping", cog.mappings.cache), ("render", cog.renders)):
+            stats = cache.stats()
+            lookups = CounterMetricFamily(f"bridge_{name}_cache_lookups", f"{name.capitalize()} cache lookups",
+                                          labels=["result"])
+            lookups.add_metric(["hit"], stats["hits"])
+            lookups.add_metric(["miss"], stats["misses"])
+            yield lookups
+            yield GaugeMetricFamily(f"bridge_{name}_cache_hit_rate", f"{name.capitalize()} cache hit rate",
+                                    value=stats["hit_rate"])
+            yield GaugeMetricFamily(f"bridge_{name}_cache_size", f"Entries in the {name} cache", value=stats["size"])
+
+
+class Metrics:
+    """
+    Optional Prometheus metrics. Everything here is a no-op until start() succeeded,
+    so call sites don't need to check whether metrics are enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.registry = None
+        self.mongo_listener = MongoListener(self)
+
+    def start(self, port, addr="0.0.0.0"):
+        if self.enabled:
+            return True
+        if prometheus_client is None:
+            log.warning("prometheus_client is not installed, metrics are disabled")
+            return False
+        registry = self.registry = prometheus_client.CollectorRegistry()
+        self.stage_seconds = prometheus_client.Histogram(
+            "bridge_stage_seconds", "Time spent in each stage of a delivery", ["stage"], registry=registry,
+            buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+        )
+        self.stages = {stage: self.stage_seconds.labels(stage) for stage in STAGES}
+        self.delivery_seconds = prometheus_client.Histogram(
+            "bridge_delivery_seconds", "Time from enqueueing a payload to delivering it to one target", ["type"],
+            registry=registry, buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+        )
+        self.api_requests = prometheus_client.Counter(
+            "discord_api_requests", "Discord REST requests", ["method", "route"], registry=registry
+        )
+        self.api_rate_limited = prometheus_client.Counter(
+            "discord_api_rate_limited", "Discord REST responses with status 429, those of webhooks with method \"webhook\"",
+            ["method", "route"], registry=registry
+        )
+        self.mongo_seconds = prometheus_client.Histogram(
+            "mongo_command_seconds", "MongoDB command latency", ["collection", "command"], registry=registry,
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+        )
+        self.mongo_failures = prometheus_client.Counter(
+            "mongo_command_failures", "Failed MongoDB commands", ["collection", "command"], registry=registry
+        )
+        prometheus_client.start_http_server(port, addr=addr, registry=registry)
+        self.enabled = True
+        log.info(f"Serving metrics on {addr}:{port}")
+        return True
+
+    def register(self, collector):
+        if self.enabled:
+            self.registry.register(collector)
+
+    def unregister(self, collector):
+        if self.enabled:
+            try:
+                self.registry.unregister(collector)
+            except KeyError:
+                pass
+
+    def span(self, stage):
+        if not self.enabled:
+            return _null_span
+        return _Span(self.stages[stage])
+
+    def delivered(self, payload_type, queued_at):
+        if self.enabled and queued_at is not None:
+            self.delivery_seconds.labels(payload_type).observe(time.monotonic() - queued_at)
+
+    def rate_limited(self, method, url):
+        # fed by the RateLimitListener, from the bot's and the webhook adapter's loggers
+        if self.enabled:
+            self.api_rate_limited.labels(method, normalize_route(url)).inc()
+
+    def instrument(self, client):
+        """Count the requests of a discord.py HTTPClient or webhook adapter."""
+        if not self.enabled or getattr(client, "_bridge_metrics", False):
+            return
+        request = client.request
+
+        async def counted_request(route, *args, **kwargs):
+            self.api_requests.labels(route.method, normalize_route(route.path)).inc()
+            return await request(route, *args, **kwargs)
+
+        client.request = counted_request
+        client._bridge_metrics = True
+
+
+metrics = Metrics()
@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import logging
+
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from utils.cfg import cfg
+from utils.snapshot import MessageSnapshot
+
+log = logging.getLogger("outbox")
+log.setLevel(cfg["log_level"])
+
+
+class Outbox:
+    """
+    Persistent log of dispatched payloads and the targets that haven't acknowledged them yet,
+    so deliveries still queued during a restart or crash are resumed on the next start.
+
+    Like the message mappings the log is written behind: an entry that is acknowledged by
+    every target before the next flush never reaches the db at all. A crash can therefore
+    lose up to flush_interval seconds of entries, new messages among them are recovered by
+    the history backfill using the per-channel cursors kept here.
+
+    Acks and cursors are only written after the mapping store was flushed, so a persisted
+    cursor never points past a message whose mapping is lost. Messages delivered within the
+    last flush_interval before a crash may have neither, the backfill sends those again.
+    """
+
+    def __init__(self, collection, cursors, flush_interval=1, mappings=None):
+        self.collection = collection
+        # source channel_id -> id of the last message delivered to every target
+        self.cursors = cursors
+        self.flush_interval = flush_interval
+        # MessageMappings flushed before acks and cursors are written
+        self.mappings = mappings
+        # outbox_id -> targets that still have to deliver the payload
+        self.remaining = {}
+        # outbox_id -> entry, not yet written
+        self.pending_inserts = {}
+        # outbox_id -> targets acknowledged since the entry was written
+        self.pending_acks = {}
+        # outbox_ids of written entries that are fully acknowledged
+        self.pending_deletes = set()
+        # source channel_id -> newest fully delivered message id, not yet written
+        self.pending_cursors = {}
+        self.in_flight = set()
+        self.lock = asyncio.Lock()
+        self.flush_task = None
+
+    def start(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_loop())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as err:
+                log.error(f"Failed to flush outbox: {err}")
+
+    def record(self, bridge_name, payload, source_channel, targets):
+        outbox_id = ObjectId()
+        payload["outbox_id"] = outbox_id
+        # digests are best effort, the messages merged into them aren't replayed either
+        if not targets or payload["type"] == "digest":
+            return
+        if payload["type"] == "bulk_deleted_messages":
+            message_ids = list(payload["message_ids"])
+        else:
+            message_ids = [payload["message"].id]
+        self.remaining[outbox_id] = set(targets)
+        doc = self.pending_inserts[outbox_id] = {
+            "_id"        : outbox_id,
+            "bridge"     : bridge_name,
+            "type"       : payload["type"],
+            "channel_id" : source_channel,
+            "message_ids": message_ids,
+            "targets"    : list(targets),
+            "created_at" : datetime.datetime.now(datetime.timezone.utc)
+        }
+        if payload["type"] in ("new_message", "edited_message"):
+            # lets any worker resume the delivery without fetching the message
+            doc["message"] = MessageSnapshot.dump(payload["message"])
+
+    def resume(self, payload, doc):
+        """Track a payload rebuilt from an entry that was already written."""
+        payload["outbox_id"] = doc["_id"]
+        self.remaining[doc["_id"]] = set(doc["targets"])
+
+    def ack(self, payload, target):
+        outbox_id = payload.get("outbox_id")
+        remaining = self.remaining.get(outbox_id)
+        if remaining is None:
+            return
+        remaining.discard(target)
+        unwritten = outbox_id in self.pending_inserts and outbox_id not in self.in_flight
+        if remaining:
+            if unwritten:
+                self.pending_inserts[outbox_id]["targets"] = list(remaining)
+            else:
+                self.pending_acks.setdefault(outbox_id, set()).add(target)
+            return
+        # every target is done with this payload
+        del self.remaining[outbox_id]
+        self.pending_acks.pop(outbox_id, None)
+        self.pending_inserts.pop(outbox_id, None)
+        if not unwritten:
+            self.pending_deletes.add(outbox_id)
+        if payload["type"] == "new_message":
+            self.advance(payload["message"].channel.id, payload["message"].id)
+
+    def advance(self, source_channel, message_id):
+        """Move a channel's cursor past a message that won't be delivered on its own, e.g. one merged into a digest."""
+        self.pending_cursors[source_channel] = max(self.pending_cursors.get(source_channel, 0), message_id)
+
+    def discard(self, outbox_id):
+        """Drop a written entry that can't be delivered anymore."""
+        self.remaining.pop(outbox_id, None)
+        self.pending_deletes.add(outbox_id)
+
+    def pending(self):
+        return len(self.remaining)
+
+    async def load(self, bridge_names=None):
+        query = {} if bridge_names is None else {"bridge": {"$in": list(bridge_names)}}
+        return await self.collection.find(query).sort("_id", 1).to_list(length=None)
+
+    async def load_cursors(self, channel_ids):
+        docs = await self.cursors.find({"_id": {"$in": list(channel_ids)}}).to_list(length=None)
+        return {doc["_id"]: doc["message_id"] for doc in docs}
+
+    async def flush(self):
+        async with self.lock:
+            inserts = dict(self.pending_inserts)
+            if inserts:
+                self.in_flight = set(inserts)
+                try:
+                    await self.collection.insert_many(
+                        [dict(doc, targets=list(doc["targets"])) for doc in inserts.values()], ordered=False
+                    )
+                except BulkWriteError as err:
+                    # partial failures are not retried, a retry would only hit duplicate keys
+                    log.error(f"Failed to write some outbox entries: {err.details.get('writeErrors')}")
+                finally:
+                    self.in_flight = set()
+                for outbox_id, doc in inserts.items():
+                    if self.pending_inserts.get(outbox_id) is doc:
+                        del self.pending_inserts[outbox_id]
+            acks = self.pending_acks
+            deletes = self.pending_deletes
+            cursors = self.pending_cursors
+            self.pending_acks, self.pending_deletes, self.pending_cursors = {}, set(), {}
+            requests = [
+                UpdateOne({"_id": outbox_id}, {"$pull": {"targets": {"$in": list(targets)}}})
+                for outbox_id, targets in acks.items() if outbox_id not in deletes
+            ]
+            requests += [DeleteOne({"_id": outbox_id}) for outbox_id in deletes]
+            try:
+                if self.mappings is not None and (requests or cursors):
+                    # the acks were taken first, so every mapping they depend on is in this flush
+                    await self.mappings.flush()
+                if requests:
+                    await self.collection.bulk_write(requests, ordered=False)
+                if cursors:
+                    await self.cursors.bulk_write([
+                        UpdateOne({"_id": channel_id}, {"$max": {"message_id": message_id}}, upsert=True)
+                        for channel_id, message_id in cursors.items()
+                    ], ordered=False)
+            except Exception:
+                # put everything back so the next flush retries it
+                for outbox_id, targets in acks.items():
+                    self.pending_acks.setdefault(outbox_id, set()).update(targets)
+                self.pending_deletes |= deletes
+                for channel_id, message_id in cursors.items():
+                    self.pending_cursors[channel_id] = max(self.pending_cursors.get(channel_id, 0), message_id)
+                raise
+            if inserts or requests or cursors:
+                log.debug(f"Flushed {len(inserts)} entries, {len(requests)} acks and {len(cursors)} cursors")
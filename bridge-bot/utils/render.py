@@ -0,0 +1,148 @@
+import json
+import re
+from collections import OrderedDict
+
+from discord import Embed
+
+
+class RenderedMessage:
+    """
+    Everything a target needs to post one version of a source message, rendered once and
+    shared by every target of the payload. The embeds are never mutated after rendering.
+    """
+
+    __slots__ = ("fingerprint", "content", "embed", "webhook_text", "webhook_embeds", "username", "avatar_url")
+
+    def __init__(self, fingerprint, content, embed, webhook_text, webhook_embeds, username, avatar_url):
+        self.fingerprint = fingerprint
+        # bot delivery
+        self.content = content
+        self.embed = embed
+        # webhook delivery, the reply link depends on the target and is added per target
+        self.webhook_text = webhook_text
+        self.webhook_embeds = webhook_embeds
+        self.username = username
+        self.avatar_url = avatar_url
+
+    def webhook_content(self, reference=None):
+        content = self.webhook_text
+        if reference:
+            content = f"> [Reply]({reference.jump_url})\n{content}"
+        return content
+
+
+def fingerprint(message):
+    # the parts of a message an edit can change and that show up in the bridged copy
+    return (
+        message.content,
+        tuple(json.dumps(embed.to_dict(), sort_keys=True) for embed in message.embeds),
+        tuple(attachment.id for attachment in message.attachments)
+    )
+
+
+def unchanged(before, after):
+    """Whether an edit left everything that gets bridged as it was, e.g. a pin or a flag change."""
+    return fingerprint(before) == fingerprint(after)
+
+
+def render_message(message, message_fingerprint=None, link_attachments=True):
+    """
+    Render a message without touching it, the same message always renders the same.
+    Without link_attachments the attachments are left out, they get uploaded instead.
+    """
+    author = f"{message.author} (#{message.channel.name} in {message.guild.name})"
+    attachments = message.attachments if link_attachments else []
+
+    if not message.embeds and not attachments:
+        if '\n' in message.content:
+            content = f"`{author}`:\n{message.content}"
+        else:
+            content = f"{message.content} `from {author}`"
+        embed = None
+    else:
+        # work on a copy, the source message may still be rendered for other payloads
+        embed = Embed.from_dict(message.embeds[0].to_dict()) if message.embeds else Embed(color=message.author.color)
+        if message.author.avatar:
+            pfp = message.author.avatar.url
+        else:
+            pfp = message.author.default_avatar.url
+        embed.set_author(name=author,
+                         icon_url=pfp)
+        embed.description = message.content or "No Message Content"
+        # try to display images largely
+        if len(attachments) == 1 and (attachments[0].content_type or "").startswith("image/"):
+            embed.set_image(url=attachments[0].url)
+        elif len(attachments) > 1:
+            # otherwise, add attachments as fields
+            for i, attachment in enumerate(attachments):
+                embed.add_field(name=f"Attachment #{i + 1}",
+                                value=f"[{attachment.description or attachment.filename}]({attachment.url})")
+        content = ""
+
+    # the webhook carries the author, so plain text needs neither attribution nor an embed
+    webhook_text = "\n".join([message.content] + [attachment.url for attachment in attachments])
+    # link previews are regenerated by discord, only forward real embeds
+    webhook_embeds = tuple(embed for embed in message.embeds if embed.type == "rich")
+    if not webhook_text and not webhook_embeds and not message.attachments:
+        webhook_text = "No Message Content"
+
+    username = f"{message.author.display_name} ({message.guild.name})"
+    # discord rejects webhook names containing these words
+    username = re.sub(r"(?i)discord|clyde", lambda m: f"{m.group(0)[0]}\u200b{m.group(0)[1:]}", username)
+
+    return RenderedMessage(
+        message_fingerprint or fingerprint(message),
+        content,
+        embed,
+        webhook_text,
+        webhook_embeds,
+        username[:80],
+        message.author.display_avatar.url
+    )
+
+
+class RenderCache:
+    """
+    Bounded LRU of the last rendering of each source message. Targets of the same payload
+    share one rendering, an edit is only rendered again if it changed what gets bridged.
+    """
+
+    def __init__(self, size=1000, link_attachments=True):
+        self.size = size
+        self.link_attachments = link_attachments
+        # message_id -> (message the rendering was made or confirmed for, RenderedMessage)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message):
+        entry = self.entries.get(message.id)
+        if entry is not None and entry[0] is message:
+            # another target of the same payload already rendered it
+            self.hits += 1
+            self.entries.move_to_end(message.id)
+            return entry[1]
+        message_fingerprint = fingerprint(message)
+        if entry is not None and entry[1].fingerprint == message_fingerprint:
+            self.hits += 1
+            rendered = entry[1]
+        else:
+            self.misses += 1
+            rendered = render_message(message, message_fingerprint, self.link_attachments)
+        self.entries[message.id] = (message, rendered)
+        self.entries.move_to_end(message.id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return rendered
+
+    def forget(self, message_id):
+        self.entries.pop(message_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size"    : len(self.entries),
+            "hits"    : self.hits,
+            "misses"  : self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -1,5 +1,8 @@
+import asyncio
+import hashlib
 import io
 import logging
+import time
 import traceback
 
 from discord import File
@@ -14,25 +17,126 @@ def format_stacktrace(error):
     return "".join(traceback.format_exception(type(error), error, error.__traceback__))
 
 
-async def report_error(excep, *args, ctx=None):
-    desc = f"**`{repr(excep)[:100]}`**\n"
-    if args:
-        desc += "```"
-        desc += "\n".join(f"args[{i}]={arg}" for i, arg in enumerate(args))
-        desc += "```\n"
-    if ctx:
-        desc += f"```{ctx.command.name=}\n" \
-                f"{ctx.command.options=}\n" \
-                f"{ctx.channel=}\n" \
-                f"{ctx.author=}```"
-
-    if hasattr(excep, "original"):
-        details = format_stacktrace(excep.original)
-    else:
-        details = format_stacktrace(excep)
-    log.error(details)
-    if not bot:
-        log.warning("cant send error as bot variable not initialized")
-    channel = await bot.fetch_channel(cfg["discord.channels.errors"])
-    with io.StringIO(details) as f:
-        await channel.send(desc, file=File(fp=f, filename="exception.txt"))
+def fingerprint(error):
+    # same exception type raised from the same place, whatever ids ended up in the message
+    frames = traceback.extract_tb(error.__traceback__)
+    key = type(error).__qualname__ + "".join(f"|{frame.filename}:{frame.lineno}" for frame in frames)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+class Reporter:
+    """
+    Posts errors to the errors channel from a background task, so reporting never holds up
+    the caller. Only the first occurrence of an error is posted, repeats are counted and
+    summed up in a digest every digest_interval seconds. Reports beyond queue_size are dropped.
+    """
+
+    def __init__(self, queue_size=100, digest_interval=300):
+        self.queue_size = queue_size
+        self.digest_interval = digest_interval
+        self.queue = None
+        # fingerprint -> [repeats since it was posted, short description]
+        self.seen = {}
+        self.dropped = 0
+        self.channel = None
+        self.task = None
+
+    def report(self, excep, *args, ctx=None):
+        desc = f"**`{repr(excep)[:100]}`**\n"
+        if args:
+            desc += "```"
+            desc += "\n".join(f"args[{i}]={arg}" for i, arg in enumerate(args))
+            desc += "```\n"
+        if ctx:
+            desc += f"```{ctx.command.name=}\n" \
+                    f"{ctx.command.options=}\n" \
+                    f"{ctx.channel=}\n" \
+                    f"{ctx.author=}```"
+
+        error = excep.original if hasattr(excep, "original") else excep
+        details = format_stacktrace(error)
+        log.error(details)
+        key = fingerprint(error)
+        if key in self.seen:
+            self.seen[key][0] += 1
+            return
+        if not self.start():
+            return
+        try:
+            self.queue.put_nowait((f"`{key}` {desc}", details))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        # only once it is on its way, a report that couldn't be queued gets another chance
+        self.seen[key] = [0, repr(excep)[:100]]
+
+    def start(self):
+        if self.task is not None:
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            log.warning("cant send error as there is no event loop running")
+            return False
+        self.queue = asyncio.Queue(self.queue_size)
+        self.task = loop.create_task(self.run())
+        return True
+
+    async def get_channel(self):
+        if self.channel is None:
+            channel_id = cfg["discord.channels.errors"]
+            self.channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        return self.channel
+
+    async def send(self, content, details=None):
+        if not bot:
+            log.warning("cant send error as bot variable not initialized")
+            return
+        try:
+            channel = await self.get_channel()
+            if details is None:
+                await channel.send(content)
+                return
+            with io.StringIO(details) as f:
+                await channel.send(content, file=File(fp=f, filename="exception.txt"))
+        except Exception as err:
+            # reporting must never fail the reporter itself
+            log.error(f"Failed to send error report: {err}")
+
+    async def run(self):
+        next_digest = time.monotonic() + self.digest_interval
+        while True:
+            try:
+                content, details = await asyncio.wait_for(self.queue.get(), timeout=max(0, next_digest - time.monotonic()))
+                await self.send(content, details)
+            except asyncio.TimeoutError:
+                pass
+            if time.monotonic() >= next_digest:
+                next_digest = time.monotonic() + self.digest_interval
+                await self.digest()
+
+    async def digest(self):
+        repeats = [(count, key, desc) for key, (count, desc) in self.seen.items() if count]
+        dropped, self.dropped = self.dropped, 0
+        # errors seen again after this get posted in full again
+        self.seen = {}
+        if not repeats and not dropped:
+            return
+        lines = [f"**Errors in the last {self.digest_interval:g} seconds**"]
+        lines += [f"`{key}` {count}x more `{desc}`" for count, key, desc in sorted(repeats, reverse=True)[:20]]
+        if len(repeats) > 20:
+            lines.append(f"and {len(repeats) - 20} more kinds of errors")
+        if dropped:
+            lines.append(f"{dropped} reports dropped, the queue was full")
+        await self.send("\n".join(lines)[:2000])
+
+
+reporter = Reporter(
+    queue_size=cfg.get("reporter.queue_size", 100),
+    digest_interval=cfg.get("reporter.digest_interval", 300)
+)
+
+
+def report_error(excep, *args, ctx=None):
+    """Queue an error report and return right away, see Reporter."""
+    reporter.report(excep, *args, ctx=ctx)
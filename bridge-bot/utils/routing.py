@@ -0,0 +1,86 @@
+"""
+Compiles a bridge document into a routing table of source channel -> targets.
+
+Without "edges" every channel of a bridge sends to every other one. A bridge can instead
+list directional edges, each optionally filtered, e.g. a one-way announcement mirror:
+
+    {
+        "name"    : "news",
+        "channels": [1, 2, 3],
+        "edges"   : [
+            {"from": 1, "to": 2},
+            {"from": 1, "to": 3, "filters": {"roles": [42], "pattern": "^\\[release\\]"}}
+        ],
+        "modes"   : {"3": "receive"}
+    }
+
+"modes" maps a channel id to "send" (it only sends) or "receive" (it is read-only, nothing
+posted there is bridged), on top of the mesh or the edges. Edge filters:
+
+    authors / exclude_authors  author ids that may / may not be bridged
+    roles                      the author needs one of these role ids
+    pattern / exclude_pattern  regex the content has to / must not match
+    bots                       false to leave out messages of bots
+"""
+import logging
+import re
+
+from utils.cfg import cfg
+
+log = logging.getLogger("routing")
+log.setLevel(cfg["log_level"])
+
+
+class EdgeFilter:
+    """Conditions a new message has to meet to be delivered over one edge."""
+
+    def __init__(self, spec):
+        self.authors = frozenset(spec.get("authors", ())) or None
+        self.exclude_authors = frozenset(spec.get("exclude_authors", ()))
+        self.roles = frozenset(spec.get("roles", ())) or None
+        self.pattern = re.compile(spec["pattern"]) if spec.get("pattern") else None
+        self.exclude_pattern = re.compile(spec["exclude_pattern"]) if spec.get("exclude_pattern") else None
+        self.bots = spec.get("bots", True)
+
+    def allows(self, message):
+        author = message.author
+        if self.authors is not None and author.id not in self.authors:
+            return False
+        if author.id in self.exclude_authors:
+            return False
+        if not self.bots and author.bot:
+            return False
+        if self.roles is not None and self.roles.isdisjoint(role.id for role in getattr(author, "roles", ())):
+            return False
+        if self.pattern is not None and not self.pattern.search(message.content):
+            return False
+        if self.exclude_pattern is not None and self.exclude_pattern.search(message.content):
+            return False
+        return True
+
+
+def compile_routes(bridge):
+    """Return {source_channel: ((target_channel, EdgeFilter or None), ...)} for one bridge document."""
+    channels = bridge["channels"]
+    modes = {int(channel_id): mode for channel_id, mode in bridge.get("modes", {}).items()}
+    edges = bridge.get("edges")
+    if edges is None:
+        edges = [{"from": source, "to": target} for source in channels for target in channels if source != target]
+    routes = {}
+    for edge in edges:
+        source, target = edge["from"], edge["to"]
+        # edges of channels that got disconnected are kept in the db but not routed
+        if source == target or source not in channels or target not in channels:
+            continue
+        if modes.get(source) == "receive" or modes.get(target) == "send":
+            continue
+        edge_filter = None
+        if edge.get("filters"):
+            try:
+                edge_filter = EdgeFilter(edge["filters"])
+            except re.error as err:
+                # better to bridge nothing over the edge than what the filter should have held back
+                log.error(f"Bridge {bridge['name']} edge {source} -> {target} has an invalid pattern, skipping it: {err}")
+                continue
+        routes.setdefault(source, []).append((target, edge_filter))
+    return {source: tuple(targets) for source, targets in routes.items()}
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import re
+import time
+
+from utils.cfg import cfg
+
+log = logging.getLogger("scheduler")
+log.setLevel(cfg["log_level"])
+
+
+class TokenBucket:
+    """
+    Classic token bucket. The rate is halved whenever discord reports a rate limit
+    and creeps back up to the configured rate with every successful acquire.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.05):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token if one is available, otherwise return how long to wait for one."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (delay := self.reserve()) > 0:
+            await asyncio.sleep(delay)
+        # additive increase back towards the configured rate
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+    def penalize(self, retry_after):
+        # multiplicative decrease, and nothing goes out until discord lets us again
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.tokens = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+
+
+class FanoutScheduler:
+    """
+    Per-target delivery queues, each drained by its own worker so a slow or rate limited
+    target only delays itself. Jobs for the same target run strictly in submission order.
+    Workers exit after idling for a while and are restarted by the next submit.
+    A target's queue holds at most max_queue sheddable jobs, further ones are refused.
+    """
+
+    def __init__(self, concurrency=50, rate=1, burst=5, idle_timeout=60, max_queue=0):
+        self.rate = rate
+        self.burst = burst
+        # 0 leaves the queues unbounded
+        self.max_queue = max_queue
+        self.idle_timeout = idle_timeout
+        # bounds the number of requests in flight over all targets
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # target -> asyncio.Queue of zero argument coroutine functions
+        self.queues = {}
+        # target -> worker task
+        self.workers = {}
+        # target -> TokenBucket, kept across worker restarts so learned limits stick
+        self.buckets = {}
+
+    def bucket(self, target):
+        bucket = self.buckets.get(target)
+        if bucket is None:
+            bucket = self.buckets[target] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def depth(self, target=None):
+        if target is not None:
+            queue = self.queues.get(target)
+            return queue.qsize() if queue else 0
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def submit(self, target, job, sheddable=False):
+        """Queue a job for a target, returns False if it was refused because the target is backed up."""
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = asyncio.Queue()
+        if sheddable and self.max_queue and queue.qsize() >= self.max_queue:
+            return False
+        queue.put_nowait(job)
+        if target not in self.workers:
+            self.workers[target] = asyncio.get_running_loop().create_task(self.worker(target, queue))
+        return True
+
+    def rate_limited(self, target, retry_after):
+        log.info(f"Target {target} rate limited for {retry_after:.2f}s")
+        self.bucket(target).penalize(retry_after)
+
+    async def worker(self, target, queue):
+        bucket = self.bucket(target)
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    # no await between the check and the cleanup, so submit() can't slip in between
+                    del self.workers[target]
+                    del self.queues[target]
+                    return
+                continue
+            await bucket.acquire()
+            async with self.semaphore:
+                try:
+                    await job()
+                except Exception as err:
+                    log.error(f"Job for target {target} failed: {err}")
+
+    async def close(self):
+        for task in self.workers.values():
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+        self.queues.clear()
+
+
+class RateLimitListener(logging.Handler):
+    """
+    discord.py handles 429s internally and only logs them, so we pick the responses
+    up from its loggers to teach the per-target buckets about the real limits.
+    Attach it to every logger in LOGGERS, webhooks are rate limited by their own adapter.
+    """
+
+    LOGGERS = ("discord.http", "discord.webhook.async_")
+    channel_route = re.compile(r"/channels/(\d+)/")
+    webhook_route = re.compile(r"/webhooks/(\d+)/")
+
+    def __init__(self, callback, webhook_channel=None, observer=None):
+        super().__init__(logging.WARNING)
+        self.callback = callback
+        # optional webhook_id -> channel_id resolver for webhook routes
+        self.webhook_channel = webhook_channel
+        # optional callable(method, url) told about every 429
+        self.observer = observer
+
+    def attach(self):
+        for name in self.LOGGERS:
+            logging.getLogger(name).addHandler(self)
+
+    def detach(self):
+        for name in self.LOGGERS:
+            logging.getLogger(name).removeHandler(self)
+
+    def emit(self, record):
+        if not isinstance(record.msg, str) or not record.args:
+            return
+        if record.msg.startswith("We are being rate limited") and "Retrying in" in record.msg and len(record.args) >= 3:
+            # requests whose wait would be too long are raised instead, they aren't retried
+            method, url, retry_after = record.args[:3]
+        elif record.msg.startswith("Webhook ID") and len(record.args) >= 2:
+            # the webhook adapter only logs the webhook id, not the request
+            webhook_id, retry_after = record.args[:2]
+            method, url = "webhook", f"/webhooks/{webhook_id}/"
+        else:
+            return
+        if self.observer:
+            self.observer(method, url)
+        channel_id = None
+        if match := self.channel_route.search(str(url)):
+            channel_id = int(match.group(1))
+        elif self.webhook_channel and (match := self.webhook_route.search(str(url))):
+            channel_id = self.webhook_channel(int(match.group(1)))
+        if channel_id is not None:
+            self.callback(channel_id, float(retry_after))
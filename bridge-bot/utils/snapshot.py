@@ -0,0 +1,108 @@
+from discord import Colour, Embed
+
+
+class _Asset:
+    def __init__(self, url):
+        self.url = url
+
+
+class _Named:
+    def __init__(self, data):
+        self.id = data["id"]
+        self.name = data["name"]
+
+
+class _Attachment:
+    def __init__(self, data):
+        self.id = data["id"]
+        self.url = data["url"]
+        self.filename = data["filename"]
+        self.description = data.get("description")
+        self.content_type = data.get("content_type")
+        self.size = data.get("size", 0)
+
+
+class _Role:
+    def __init__(self, id):
+        self.id = id
+
+
+class _Reference:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class SnapshotAuthor:
+    def __init__(self, data):
+        self.id = data["id"]
+        self.name = data["name"]
+        self.display_name = data["display_name"]
+        self.bot = data.get("bot", False)
+        self.color = self.colour = Colour(data["color"])
+        self.display_avatar = self.avatar = self.default_avatar = _Asset(data["avatar_url"])
+        self.roles = [_Role(role_id) for role_id in data.get("roles", ())]
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class MessageSnapshot:
+    """
+    The parts of a discord.Message the bridge reads, in a form that can be stored in the db
+    and rebuilt by another worker process that doesn't have the message in its cache.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.id = data["id"]
+        self.channel = _Named(data["channel"])
+        self.guild = _Named(data["guild"])
+        self.author = SnapshotAuthor(data["author"])
+        self.content = data["content"]
+        self.embeds = [Embed.from_dict(embed) for embed in data["embeds"]]
+        self.attachments = [_Attachment(attachment) for attachment in data["attachments"]]
+        self.reference = _Reference(data["reference"]) if data.get("reference") else None
+        self.mentions = data["mentions"]
+        self.webhook_id = data.get("webhook_id")
+
+    @staticmethod
+    def dump(message):
+        if isinstance(message, MessageSnapshot):
+            return message.data
+        return {
+            "id"         : message.id,
+            "channel"    : {"id": message.channel.id, "name": message.channel.name},
+            "guild"      : {"id": message.guild.id, "name": message.guild.name},
+            "author"     : {
+                "id"          : message.author.id,
+                "name"        : str(message.author),
+                "display_name": message.author.display_name,
+                "bot"         : message.author.bot,
+                "color"       : message.author.color.value,
+                "avatar_url"  : message.author.display_avatar.url,
+                # only members have roles, read by the edge filters
+                "roles"       : [role.id for role in getattr(message.author, "roles", ())]
+            },
+            "content"    : message.content,
+            "embeds"     : [embed.to_dict() for embed in message.embeds],
+            "attachments": [
+                {
+                    "id"          : attachment.id,
+                    "url"         : attachment.url,
+                    "filename"    : attachment.filename,
+                    "description" : attachment.description,
+                    "content_type": attachment.content_type,
+                    "size"        : attachment.size
+                }
+                for attachment in message.attachments
+            ],
+            "reference"  : message.reference.message_id if message.reference else None,
+            "mentions"   : [user.id for user in message.mentions],
+            "webhook_id" : message.webhook_id
+        }
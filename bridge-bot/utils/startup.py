@@ -0,0 +1,46 @@
+import contextlib
+import logging
+import time
+
+from utils.cfg import cfg
+
+log = logging.getLogger("startup")
+log.setLevel(cfg["log_level"])
+
+
+class StartupTimer:
+    """Wall clock timings of the startup phases, some of them overlap. Each is logged as it ends."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # phase -> (seconds after launch it began, seconds it took)
+        self.phases = {}
+        self.marks = {}
+
+    def begin(self, name):
+        self.marks[name] = time.perf_counter()
+
+    def end(self, name):
+        begin = self.marks.pop(name, None)
+        if begin is None:
+            return
+        now = time.perf_counter()
+        self.phases[name] = (begin - self.started, now - begin)
+        log.info(f"Startup: {name} took {now - begin:.2f}s, {now - self.started:.2f}s after launch")
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def summary(self):
+        return ", ".join(
+            f"{name} {duration:.2f}s at +{offset:.2f}s"
+            for name, (offset, duration) in sorted(self.phases.items(), key=lambda item: item[1][0])
+        )
+
+
+startup = StartupTimer()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from discord import Forbidden, Webhook
+
+from utils.cfg import cfg
+
+log = logging.getLogger("webhooks")
+log.setLevel(cfg["log_level"])
+
+
+class WebhookPool:
+    """
+    One webhook per target channel, created on first use and cached in memory and in the db.
+
+    Channels where the bot may not manage webhooks are remembered as None so callers
+    can fall back to sending as the bot without asking Discord again.
+    """
+
+    def __init__(self, bot, collection, name="Bridge"):
+        self.bot = bot
+        self.collection = collection
+        self.name = name
+        # channel_id -> Webhook, or None if webhooks can't be used in that channel
+        self.webhooks = {}
+        # webhook_id -> channel_id of our own webhooks, messages sent through them must never be bridged again
+        self.webhook_ids = {}
+        # ids of webhooks known not to be ours, so their messages don't cost a lookup each
+        self.foreign = set()
+        self.locks = {}
+
+    async def load(self):
+        # is_own looks up webhooks other workers created by their id
+        await self.collection.create_index("webhook_id")
+        async for doc in self.collection.find():
+            webhook = Webhook.partial(doc["webhook_id"], doc["token"], client=self.bot)
+            self.webhooks[doc["_id"]] = webhook
+            self.webhook_ids[webhook.id] = doc["_id"]
+        log.info(f"Loaded {len(self.webhook_ids)} webhooks")
+
+    async def is_own(self, webhook_id, application_id=None):
+        if webhook_id in self.webhook_ids:
+            return True
+        # webhooks created by the bot carry its application id
+        if application_id is not None and int(application_id) == getattr(self.bot, "application_id", None):
+            return True
+        if webhook_id in self.foreign:
+            return False
+        # another worker may have created it since we loaded ours, it is stored before it is first used
+        doc = await self.collection.find_one({"webhook_id": webhook_id}, {"_id": 1})
+        if doc is None:
+            self.foreign.add(webhook_id)
+            return False
+        self.webhook_ids[webhook_id] = doc["_id"]
+        return True
+
+    def channel_of(self, webhook_id):
+        return self.webhook_ids.get(webhook_id)
+
+    def cached(self, channel_id):
+        return self.webhooks.get(channel_id)
+
+    async def get(self, channel):
+        if channel.id in self.webhooks:
+            return self.webhooks[channel.id]
+        if not hasattr(channel, "create_webhook"):
+            # partial channel of a guild on another shard, only a stored webhook can be used
+            return None
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            if channel.id in self.webhooks:
+                return self.webhooks[channel.id]
+            try:
+                webhook = None
+                for existing in await channel.webhooks():
+                    if existing.user == self.bot.user and existing.token:
+                        webhook = existing
+                        break
+                if webhook is None:
+                    webhook = await channel.create_webhook(name=self.name)
+                    log.info(f"Created webhook for channel {channel.id}")
+            except Forbidden:
+                log.warning(f"Missing permission to manage webhooks in channel {channel.id}, sending as bot")
+                self.webhooks[channel.id] = None
+                return None
+            self.webhooks[channel.id] = webhook
+            self.webhook_ids[webhook.id] = channel.id
+            await self.collection.update_one(
+                {"_id": channel.id},
+                {"$set": {"webhook_id": webhook.id, "token": webhook.token}},
+                upsert=True
+            )
+            return webhook
+
+    async def invalidate(self, channel_id):
+        # the webhook was deleted behind our back, a new one is created on next use
+        webhook = self.webhooks.pop(channel_id, None)
+        if webhook is not None:
+            self.webhook_ids.pop(webhook.id, None)
+        await self.collection.delete_one({"_id": channel_id})
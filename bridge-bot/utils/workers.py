@@ -0,0 +1,169 @@
+import asyncio
+import datetime
+import logging
+import math
+
+from pymongo.errors import DuplicateKeyError
+
+from utils.cfg import cfg
+from utils.snapshot import MessageSnapshot
+
+log = logging.getLogger("workers")
+log.setLevel(cfg["log_level"])
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class LeaseManager:
+    """
+    Spreads bridges over worker processes with leases in the db, so every bridge is
+    driven by exactly one worker. Each worker heartbeats, renews what it holds and
+    takes unowned or expired bridges until it holds its fair share of them.
+    """
+
+    def __init__(self, leases, workers, worker_id, ttl=30, on_acquire=None):
+        self.leases = leases
+        self.workers = workers
+        self.worker_id = worker_id
+        self.ttl = ttl
+        # called with the names of newly acquired bridges
+        self.on_acquire = on_acquire
+        self.names = set()
+        self.owned = set()
+        self.task = None
+
+    def owns(self, bridge_name):
+        return bridge_name in self.owned
+
+    def set_names(self, names):
+        self.names = set(names)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        # hand everything back right away instead of making the others wait for the expiry
+        await self.leases.delete_many({"owner": self.worker_id})
+        await self.workers.delete_one({"_id": self.worker_id})
+        self.owned = set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as err:
+                log.error(f"Failed to refresh leases: {err}")
+            await asyncio.sleep(self.ttl / 3)
+
+    async def refresh(self):
+        now = utcnow()
+        expires_at = now + datetime.timedelta(seconds=self.ttl)
+        await self.workers.update_one({"_id": self.worker_id}, {"$set": {"expires_at": expires_at}}, upsert=True)
+        live_workers = await self.workers.count_documents({"expires_at": {"$gt": now}})
+        share = math.ceil(len(self.names) / max(live_workers, 1))
+
+        await self.leases.update_many({"owner": self.worker_id}, {"$set": {"expires_at": expires_at}})
+        owned = {
+            doc["_id"] for doc in await self.leases.find({"owner": self.worker_id}, {"_id": 1}).to_list(length=None)
+        }
+        # let go of bridges that are gone or above our share, another worker picks them up
+        for name in sorted(owned - self.names) + sorted(owned & self.names)[share:]:
+            await self.leases.delete_one({"_id": name, "owner": self.worker_id})
+            owned.discard(name)
+        for name in sorted(self.names - owned):
+            if len(owned) >= share:
+                break
+            try:
+                await self.leases.update_one(
+                    {"_id": name, "$or": [{"owner": self.worker_id}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": self.worker_id, "expires_at": expires_at}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                # held by a live worker
+                continue
+            owned.add(name)
+        acquired = owned - self.owned
+        if acquired or self.owned - owned:
+            log.info(f"Worker {self.worker_id} now drives {sorted(owned)}")
+        self.owned = owned
+        if acquired and self.on_acquire:
+            await self.on_acquire(acquired)
+
+
+class Forwarder:
+    """
+    Hands payloads for bridges driven by another worker over through the db, and picks up
+    the ones other workers handed to us. Messages travel as MessageSnapshots so the
+    receiving worker doesn't need the source guild in its cache.
+    """
+
+    def __init__(self, collection, leases, deliver, interval=0.25):
+        self.collection = collection
+        self.leases = leases
+        # callable(bridge_name, payload) for payloads picked up from other workers
+        self.deliver = deliver
+        self.interval = interval
+        self.pending = []
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    def forward(self, bridge_name, payload):
+        doc = {"bridge": bridge_name, "type": payload["type"], "created_at": utcnow()}
+        if payload["type"] == "bulk_deleted_messages":
+            doc.update(channel_id=payload["channel_id"], message_ids=list(payload["message_ids"]))
+        elif payload["type"] == "deleted_message":
+            doc.update(channel_id=payload["message"].channel.id, message_ids=[payload["message"].id])
+        elif payload["type"] == "digest":
+            doc.update(channel_id=payload["channel_id"], content=payload["content"])
+        else:
+            doc.update(channel_id=payload["message"].channel.id, message=MessageSnapshot.dump(payload["message"]))
+        if payload.get("replay"):
+            doc["replay"] = True
+        self.pending.append(doc)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        docs, self.pending = self.pending, []
+        try:
+            await self.collection.insert_many(docs, ordered=True)
+        except Exception:
+            self.pending[:0] = docs
+            raise
+
+    async def run(self):
+        while True:
+            try:
+                await self.flush()
+                await self.receive()
+            except Exception as err:
+                log.error(f"Failed to exchange forwarded payloads: {err}")
+            await asyncio.sleep(self.interval)
+
+    async def receive(self):
+        if not self.leases.owned:
+            return
+        docs = await self.collection.find(
+            {"bridge": {"$in": list(self.leases.owned)}}
+        ).sort("_id", 1).limit(500).to_list(length=None)
+        if not docs:
+            return
+        await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        for doc in docs:
+            self.deliver(doc["bridge"], doc)